@@ -1,18 +1,130 @@
 import argparse
+import csv
 import json
 import logging
+import re
+import sys
 import src.config as conf
 import os
 from datetime import datetime
 from src.config import PromptType
-from src.tgen.test_generator import TestGenerator
-from src.tgen.test_runner import get_test_results
+from src.llm.async_driver import get_responses
+from src.llm.model_registry import get_adapter
+from src.tgen.job_ledger import JobLedger, digest
+from src.tgen.manifest import TARGET_FIELDS, load_manifest
+from src.tgen.scheduler import BatchScheduler
+from src.tgen.test_generator import Candidate, TestGenerator
+from src.tgen.test_runner import TestRunnerPool, compact_report, get_test_results, pass_count, pass_rate
+
+def parse_bool(value: str) -> bool:
+    # `type=bool` would turn any non-empty string, including "False", into True
+    if value.lower() in ('true', 'yes', '1'):
+        return True
+    if value.lower() in ('false', 'no', '0'):
+        return False
+    raise argparse.ArgumentTypeError(f"Expected true or false, got {value}")
+
+
+def add_generation_args(parser: argparse.ArgumentParser, grid: bool = False):
+    parser.add_argument(
+        "-it",
+        "--improvement_iterations",
+        type=int,
+        choices=range(0, conf.llm['max-iterations'] + 1),
+        default=conf.llm['default-improvement-iterations'],
+        help="How many improvement iterations to be used",
+        required=False
+    )
+
+    parser.add_argument(
+        "-ss",
+        "--sample_size",
+        type=int,
+        choices=range(1, conf.llm['max-sample-size'] + 1),
+        default=conf.llm['default-sample-size'],
+        help="How many samples should be generated at each invocation",
+        required=False
+    )
+
+    if grid:
+        # Every combination of the given temperatures, prompt types and models is run
+        parser.add_argument(
+            "-tr",
+            "--temperatures",
+            type=float,
+            nargs='+',
+            default=[conf.llm['default-temp']],
+            help="The temperatures to be used",
+            required=False
+        )
+
+        parser.add_argument(
+            "-pt",
+            "--prompt_types",
+            type=PromptType,
+            nargs='+',
+            choices=list(PromptType),
+            default=[PromptType.SIMPLE],
+            help="Prompt types to be used",
+            required=False
+        )
+
+        parser.add_argument(
+            "-md",
+            "--models",
+            nargs='+',
+            choices=list(conf.llm['valid-models']),
+            default=[conf.llm['default-model']],
+            help="Models to be used",
+            required=False
+        )
+    else:
+        parser.add_argument(
+            "-tr",
+            "--temperature",
+            type=float,
+            default=conf.llm['default-temp'],
+            help="The temperature to be used",
+            required=False
+        )
+
+        parser.add_argument(
+            "-pt",
+            "--prompt_type",
+            type=PromptType,
+            choices=list(PromptType),
+            default=PromptType.SIMPLE,
+            help="Prompt type to be used",
+            required=False
+        )
+
+        parser.add_argument(
+            "-md",
+            "--model",
+            choices=list(conf.llm['valid-models']),
+            default=conf.llm['default-model'],
+            help="Model to be used",
+            required=False
+        )
+
+    parser.add_argument(
+        "-rc",
+        "--read_from_cache",
+        type=parse_bool,
+        default=True,
+        help="Whether to read the invocation from cache",
+        required=False
+    )
+
+    parser.add_argument(
+        "-sv",
+        "--save_to_cache",
+        type=parse_bool,
+        default=True,
+        help="Whether to save the invocation to cache",
+        required=False
+    )
 
-logging.basicConfig(filename='logs/logging_{:%Y-%m-%d-%H-%M}.log'.format(datetime.now()),
-                    filemode='a',
-                    format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
-                    datefmt='%H:%M:%S',
-                    level=logging.INFO)
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -59,87 +171,253 @@ def get_args():
         required=False,
     )
 
+    add_generation_args(parser)
+
     parser.add_argument(
-        "-it",
-        "--improvement_iterations",
-        type=int,
-        choices=range(0, conf.llm['max-iterations'] + 1),
-        default=conf.llm['default-improvement-iterations'],
-        help="How many improvement iterations to be used",
-        required=False
+        "-lsf",
+        "--lib_src_file",
+        help="Absolute path to the library source file to be tested. Set iff you want to generate tests for the library",
+        required=False,
     )
 
+    args = parser.parse_args()
+
+    return (args.root_dir, args.src_file, args.src_class, args.output_path, args.test_file, args.test_methods,
+            args.improvement_iterations, args.sample_size, args.temperature, args.prompt_type, args.model,
+            args.read_from_cache, args.save_to_cache, args.lib_src_file)
+
+
+def add_job_args(parser: argparse.ArgumentParser):
     parser.add_argument(
-        "-ss",
-        "--sample_size",
+        "-lw",
+        "--llm_workers",
         type=int,
-        choices=range(1, conf.llm['default-sample-size'] + 1),
-        default=conf.llm['default-sample-size'],
-        help="How many samples should be generated at each invocation",
+        default=conf.test_runner['max-llm-workers'],
+        help="How many targets can generate prompts and wait for the LLM at the same time",
         required=False
     )
 
     parser.add_argument(
-        "-tr",
-        "--temperature",
-        type=float,
-        default=conf.llm['default-temp'],
-        help="The temperature to be used",
+        "-tw",
+        "--test_workers",
+        type=int,
+        default=conf.test_runner['max-test-workers'],
+        help="How many generated test files can run at the same time",
         required=False
     )
 
     parser.add_argument(
-        "-pt",
-        "--prompt_type",
-        type=PromptType,
-        choices=list(PromptType),
-        default=PromptType.SIMPLE,
-        help="Prompt type to be used",
+        "-rp",
+        "--repetitions",
+        type=int,
+        default=1,
+        help="How many times each target is generated with the same options, each with its own LLM responses",
         required=False
     )
 
     parser.add_argument(
-        "-md",
-        "--model",
-        choices=list(conf.llm['valid-models']),
-        default=conf.llm['default-model'],
-        help="Model to be used",
+        "-jl",
+        "--job_ledger",
+        default=conf.test_runner['job-ledger-file'],
+        help="SQLite file recording the progress of each job, used to resume interrupted batches",
         required=False
     )
 
+
+def add_manifest_arg(parser: argparse.ArgumentParser):
     parser.add_argument(
-        "-rc",
-        "--read_from_cache",
-        type=bool,
-        default=True,
-        help="Whether to read the invocation from cache",
-        required=False
+        "-m",
+        "--manifest",
+        help="Path to a JSON/YAML manifest with the root_dir, src_file, src_class, test_file, test_methods, "
+             "output_path (and optionally lib_src_file) of each target",
+        required=True
     )
 
+
+def get_batch_args(argv: list[str]):
+    parser = argparse.ArgumentParser(prog="main.py batch",
+                                     description="Generate PBTs for all targets of a manifest in a single process")
+
+    add_manifest_arg(parser)
+    add_generation_args(parser)
+    add_job_args(parser)
+
+    return parser.parse_args(argv)
+
+
+def get_sweep_args(argv: list[str]):
+    parser = argparse.ArgumentParser(prog="main.py sweep",
+                                     description="Generate PBTs for all targets of a manifest with every combination "
+                                                 "of the given models, temperatures and prompt types")
+
+    add_manifest_arg(parser)
+    add_generation_args(parser, grid=True)
+    add_job_args(parser)
+
     parser.add_argument(
-        "-sv",
-        "--save_to_cache",
-        type=bool,
-        default=True,
-        help="Whether to save the invocation to cache",
+        "-o",
+        "--output",
+        default="sweep_results.csv",
+        help="Path to the CSV file with the results of all jobs",
         required=False
     )
 
-    parser.add_argument(
-        "-lsf",
-        "--lib_src_file",
-        help="Absolute path to the library source file to be tested. Set iff you want to generate tests for the library",
-        required=False,
-    )
+    return parser.parse_args(argv)
 
-    args = parser.parse_args()
 
-    return (args.root_dir, args.src_file, args.src_class, args.output_path, args.test_file, args.test_methods,
-            args.improvement_iterations, args.sample_size, args.temperature, args.prompt_type, args.model,
-            args.read_from_cache, args.save_to_cache, args.lib_src_file)
+def job_src_file(job: dict) -> str:
+    return job['lib_src_file'] if job['lib_src_file'] else job['src_file']
+
+
+def prefetch_initial_responses(jobs: list[dict], test_generators: dict, args):
+    """Gets the initial responses of all jobs with concurrent async requests, identical prompts sharing one, so that
+    the jobs find them in the invocation cache."""
+    prompts = {}
+    for job in jobs:
+        test_generator = test_generators[(job['config_index'], job['lib_src_file'] is None)]
+        try:
+            prompt = test_generator.generate_initial_prompt(job['root_dir'], job_src_file(job), job['src_class'],
+                                                            job['test_file'], job['test_methods'], job['repetition'])
+        except Exception:
+            # The job fails with the same error once it runs
+            continue
+        prompts.setdefault(test_generator.model, []).append(prompt)
+
+    for model, model_prompts in prompts.items():
+        logging.info(f"Prefetching {len(model_prompts)} initial responses of {model}")
+        llm = get_adapter(model, read_from_cache=args.read_from_cache, save_to_cache=args.save_to_cache)
+        errors = [r for r in get_responses(llm, model_prompts, return_exceptions=True) if isinstance(r, BaseException)]
+        if errors:
+            logging.warning(f"Prefetching {len(errors)}/{len(model_prompts)} initial responses of {model} failed, "
+                            f"their jobs will request them again: {errors[0]!r}")
+
+
+def run_jobs(targets: list[dict], configs: list[dict], args) -> tuple[JobLedger, list[dict]]:
+    """Runs every (target, config, repetition) job that isn't done yet according to the job ledger, and returns the
+    ledger and all jobs."""
+    # App and library targets only differ in how their prompts are built, everything else is shared
+    test_generators = {(i, for_app): TestGenerator(config['model'], config['improvement_iterations'],
+                                                   PromptType(config['prompt_type']), config['temperature'],
+                                                   config['sample_size'], args.read_from_cache, args.save_to_cache,
+                                                   for_app)
+                       for i, config in enumerate(configs) for for_app in (True, False)}
+
+    ledger = JobLedger(args.job_ledger)
+    jobs = []
+    for target in targets:
+        for i, config in enumerate(configs):
+            for repetition in range(args.repetitions):
+                job_id = JobLedger.job_id({field: target[field] for field in TARGET_FIELDS}, config, repetition)
+                ledger.add_job(job_id, target, config, repetition)
+                jobs.append(dict(target, job_id=job_id, config_index=i, repetition=repetition))
+    pending_jobs = [job for job in jobs if ledger.job_state(job['job_id']) != JobLedger.DONE]
+    logging.info(f"Resuming {len(pending_jobs)}/{len(jobs)} unfinished jobs")
+
+    def process_job(job: dict, run_tests):
+        logging.info(f"Generating PBT for {job} with {configs[job['config_index']]}")
+        ledger.set_job_state(job['job_id'], JobLedger.RUNNING)
+        try:
+            report_generated_test(job['output_path'], job['root_dir'],
+                                  job_src_file(job), job['src_class'], job['test_file'],
+                                  test_generators[(job['config_index'], job['lib_src_file'] is None)],
+                                  job['test_methods'], run_tests, ledger, job['job_id'], job['repetition'])
+        except BaseException:
+            ledger.set_job_state(job['job_id'], JobLedger.FAILED)
+            raise
+        ledger.set_job_state(job['job_id'], JobLedger.DONE)
+
+    # Jobs only read prefetched responses back from the cache, and streamed ones are cut short by the jobs themselves
+    if (conf.llm['prefetch-initial-responses'] and args.read_from_cache and args.save_to_cache
+            and not conf.llm['stream-responses']):
+        prefetch_initial_responses(pending_jobs, test_generators, args)
+
+    scheduler = BatchScheduler(max(1, args.llm_workers), max(1, args.test_workers))
+    failed_jobs = scheduler.run(pending_jobs, process_job)
+
+    print(f"Generated PBTs for {len(pending_jobs) - len(failed_jobs)}/{len(pending_jobs)} jobs"
+          f" ({len(jobs) - len(pending_jobs)} already done)")
+    for job in failed_jobs:
+        print(f"  failed: {job['src_class']} in {job['root_dir']} with {configs[job['config_index']]}")
+    return ledger, jobs
+
+
+def get_config(args, model: str, temperature: float, prompt_type: PromptType) -> dict:
+    return {'model': model, 'improvement_iterations': args.improvement_iterations, 'sample_size': args.sample_size,
+            'temperature': temperature, 'prompt_type': str(prompt_type)}
+
+
+def batch_main(argv: list[str]) -> None:
+    args = get_batch_args(argv)
+    targets = load_manifest(args.manifest)
+    logging.info(f"Running batch of {len(targets)} targets from {args.manifest} with model: {args.model},"
+                 f" improvement_iterations: {args.improvement_iterations}, sample_size: {args.sample_size},"
+                 f" temperature: {args.temperature}, prompt_type: {args.prompt_type},"
+                 f" read_from_cache: {args.read_from_cache}, save_to_cache: {args.save_to_cache},"
+                 f" llm_workers: {args.llm_workers}, test_workers: {args.test_workers},"
+                 f" repetitions: {args.repetitions}, job_ledger: {args.job_ledger}")
+
+    run_jobs(targets, [get_config(args, args.model, args.temperature, args.prompt_type)], args)
+
+
+def sweep_main(argv: list[str]) -> None:
+    args = get_sweep_args(argv)
+    targets = load_manifest(args.manifest)
+    # Repeated grid values would only create duplicate jobs
+    configs = [get_config(args, model, temp, prompt_type)
+               for model in dict.fromkeys(args.models) for temp in dict.fromkeys(args.temperatures)
+               for prompt_type in dict.fromkeys(args.prompt_types)]
+    logging.info(f"Running sweep of {len(targets)} targets from {args.manifest} over {len(configs)} configs"
+                 f" (models: {args.models}, temperatures: {args.temperatures}, prompt_types: {args.prompt_types}),"
+                 f" improvement_iterations: {args.improvement_iterations}, sample_size: {args.sample_size},"
+                 f" read_from_cache: {args.read_from_cache}, save_to_cache: {args.save_to_cache},"
+                 f" llm_workers: {args.llm_workers}, test_workers: {args.test_workers},"
+                 f" repetitions: {args.repetitions}, job_ledger: {args.job_ledger}")
+
+    ledger, jobs = run_jobs(targets, configs, args)
+    write_sweep_results(args.output, ledger, jobs, configs)
+    print(f"Results of {len(jobs)} jobs written to {args.output}")
+
+
+SWEEP_RESULT_FIELDS = ['model', 'temperature', 'prompt_type', 'sample_size', 'improvement_iterations', 'repetition',
+                       'root_dir', 'src_class', 'state', 'tests', 'best_test', 'passed', 'total', 'pass_rate',
+                       'duration']
+
+
+def write_sweep_results(output: str, ledger: JobLedger, jobs: list[dict], configs: list[dict]):
+    """Writes a row per job with the results of its best test file."""
+    with open(output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=SWEEP_RESULT_FIELDS)
+        writer.writeheader()
+        for job in jobs:
+            candidates = []
+            for test_path, result_path in ledger.test_paths(job['job_id']):
+                if result_path and os.path.isfile(result_path):
+                    with open(result_path, 'r') as result_file:
+                        candidates.append(Candidate(test_path, '', json.load(result_file)))
+            best = TestGenerator.best_candidate(candidates) if candidates else Candidate(None, '', None)
+            summary = (best.report or {}).get('summary', {})
+            writer.writerow({**configs[job['config_index']], 'repetition': job['repetition'],
+                             'root_dir': job['root_dir'], 'src_class': job['src_class'],
+                             'state': ledger.job_state(job['job_id']), 'tests': len(candidates),
+                             'best_test': best.test, 'passed': pass_count(best.report),
+                             'total': summary.get('total', 0), 'pass_rate': pass_rate(best.report),
+                             'duration': (best.report or {}).get('duration')})
 
 
 def main() -> None:
+    # Configured here rather than on import, as test runs forked from the warm worker import this module too
+    logging.basicConfig(filename='logs/logging_{:%Y-%m-%d-%H-%M}.log'.format(datetime.now()),
+                        filemode='a',
+                        format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
+                        datefmt='%H:%M:%S',
+                        level=logging.INFO)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        batch_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'sweep':
+        sweep_main(sys.argv[2:])
+        return
 
     (root_dir, src_file, src_class, output_path, test_file, test_methods, improvement_iterations, sample_size, temp,
         prompt_type, model, read_from_cache, save_to_cache, lib_src_file) = get_args()
@@ -153,25 +431,65 @@ def main() -> None:
     test_generator = TestGenerator(model, improvement_iterations, prompt_type, temp, sample_size,
                                    read_from_cache, save_to_cache, lib_src_file is None)
 
-    report_generated_test(output_path, root_dir, lib_src_file if lib_src_file else src_file,
-                          src_class, test_file, test_generator, test_methods)
+    with TestRunnerPool() as test_runner:
+        report_generated_test(output_path, root_dir, lib_src_file if lib_src_file else src_file,
+                              src_class, test_file, test_generator, test_methods, test_runner.run)
 
 
-def report_generated_test(output_path, root_dir, src_file, src_class, test_file, test_generator, test_methods):
+def report_generated_test(output_path, root_dir, src_file, src_class, test_file, test_generator, test_methods,
+                          run_tests=get_test_results, ledger: JobLedger | None = None, job_id: str | None = None,
+                          repetition: int = 0):
     full_output_path = str(os.path.join(root_dir, output_path))
-    test_cmn_filename = f'test_{src_class}_properties_'
-    old_tests = [f for f in os.listdir(full_output_path) if os.path.isfile(os.path.join(full_output_path, f))
-                 and test_cmn_filename in f and f.endswith('.py')]
+    old_test_numbers = [int(m[1]) for f in os.listdir(full_output_path)
+                        if (m := re.fullmatch(rf'test_{src_class}_properties_(\d+)\.py', f))]
+
+    next_test_number = max(old_test_numbers, default=-1) + 1
+    test_seq = 0
+    test_paths = {}
+
+    def run_generated_test(generated_test: str) -> dict:
+        # Every candidate, including the ones from improvement iterations, is kept in its own numbered file
+        nonlocal next_test_number, test_seq
+        if ledger:
+            # A resumed job reuses the numbers it reserved before and skips the tests that already ran
+            test_number = ledger.reserve_test(job_id, test_seq, full_output_path, src_class, next_test_number)
+        else:
+            test_number = next_test_number
+            next_test_number += 1
+        seq = test_seq
+        test_seq += 1
+
+        test_filename = f'test_{src_class}_properties_{test_number}.py'
+        generated_test_path = f'{full_output_path}/{test_filename}'
+        test_paths[generated_test] = generated_test_path
+        test_result_path = generated_test_path.replace('.py', '_result.txt')
+
+        if ledger and ledger.tested_result_path(job_id, seq, digest(generated_test)) == test_result_path:
+            logging.info(f"Reusing the result of {generated_test_path}")
+            with open(test_result_path, 'r') as f:
+                return json.load(f)
+
+        with open(generated_test_path, 'w') as f:
+            f.write(generated_test)
 
-    test_filename = f'test_{src_class}_properties_{len(old_tests)}.py'
-    generated_test_path = f'{full_output_path}/{test_filename}'
+        test_results = run_tests(generated_test_path)
+        with open(test_result_path, 'w') as f:
+            if conf.test_runner['result-format'] == 'compact':
+                json.dump(compact_report(test_results), f, indent=4)
+            else:
+                json.dump(test_results, f, indent=4)
+        if ledger:
+            ledger.set_tested(job_id, seq, digest(generated_test), test_result_path)
+        return test_results
 
-    with open(generated_test_path, 'w') as f:
-        f.write(test_generator.generate_pbt(root_dir, src_file, src_class, test_file, test_methods))
+    candidates = test_generator.generate_pbt(root_dir, src_file, src_class, test_file, test_methods,
+                                             run_generated_test, repetition)
 
-    test_result_path = generated_test_path.replace('.py', '_result.txt')
-    with open(test_result_path, 'w') as f:
-        json.dump(get_test_results(generated_test_path), f, indent=4)
+    if len(candidates) > 1 or test_generator.improvement_iterations > 0:
+        # The best of all candidates of this run is also saved next to its numbered file as `_fixed`
+        best_test = TestGenerator.best_candidate(candidates).test
+        with open(test_paths[best_test].replace('.py', '_fixed.py'), 'w') as f:
+            f.write(best_test)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,97 @@
+import argparse
+from datetime import datetime
+import src.config as conf
+from src.llm.invocation_cache import get_invocation_cache
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Maintenance commands for the LLM invocation cache")
+
+    parser.add_argument(
+        "-cd",
+        "--cache_dir",
+        default=conf.llm['llm-invocation-cache-dir'],
+        help="Path to the LLM invocation cache directory",
+        required=False
+    )
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser(
+        "reindex",
+        help="Import cache files that are missing from the index (e.g. files written before the index existed)"
+    )
+
+    subparsers.add_parser(
+        "reshard",
+        help="Move existing cache files into the sharded directory layout without rewriting their content"
+    )
+
+    subparsers.add_parser(
+        "recompress",
+        help="Rewrite existing cache files and prompt blobs with the configured llm-invocation-cache-compression"
+    )
+
+    subparsers.add_parser(
+        "gc",
+        help="Evict entries until the cache fits the budget configured in src/config.py"
+    )
+
+    stats_parser = subparsers.add_parser(
+        "stats",
+        help="Report the cache size, per-model breakdown, hit ratio and oldest/largest entries"
+    )
+
+    stats_parser.add_argument(
+        "-t",
+        "--top",
+        type=int,
+        default=5,
+        help="How many of the oldest and largest entries to list",
+        required=False
+    )
+
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = get_args()
+    cache = get_invocation_cache(args.cache_dir)
+
+    match args.command:
+        case 'reindex':
+            print(f"Indexed {cache.import_existing()} cache files")
+        case 'reshard':
+            print(f"Moved {cache.reshard()} cache files")
+        case 'recompress':
+            print(f"Rewrote {cache.recompress()} cache files and prompt blobs")
+        case 'gc':
+            print(f"Evicted {cache.gc()} cache files")
+        case 'stats':
+            print_stats(cache.index.stats(args.top))
+
+
+def print_stats(stats: dict) -> None:
+    lookups = stats['hits'] + stats['misses']
+    hit_ratio = f"{stats['hits'] / lookups:.1%}" if lookups else 'n/a'
+
+    print(f"Entries: {stats['entries']} ({stats['entry_bytes']} bytes)")
+    print(f"Prompt blobs: {stats['blobs']} ({stats['blob_bytes']} bytes)")
+    print(f"Total size: {stats['entry_bytes'] + stats['blob_bytes']} bytes")
+    print(f"Lookups: {lookups}, hits: {stats['hits']}, misses: {stats['misses']}, hit ratio: {hit_ratio}")
+
+    print("Per model:")
+    for model, count, size in stats['models']:
+        print(f"  {model}: {count} entries, {size} bytes")
+
+    print("Oldest entries:")
+    for path, created, size in stats['oldest']:
+        print(f"  {path}: created {datetime.fromtimestamp(created):%Y-%m-%d %H:%M}, {size} bytes")
+
+    print("Largest entries:")
+    for path, created, size in stats['largest']:
+        print(f"  {path}: {size} bytes, created {datetime.fromtimestamp(created):%Y-%m-%d %H:%M}")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,15 +9,68 @@ class PromptType(Enum):
 
 llm = {
     'llm-invocation-cache-dir': 'cache/llm_invocations',
-    'api-url': 'https://openrouter.ai/api/v1',
+    'llm-invocation-index-file': 'index.sqlite3',
+    'llm-invocation-cache-shard-chars': 2,
+    'llm-invocation-cache-compression': None, # None, 'gzip' or 'zstd' (requires the zstandard package)
+    'llm-invocation-cache-dedup-prompts': True,
+    'llm-invocation-memory-cache-entries': 256,
+    'llm-invocation-memory-cache-bytes': 64 * 1024 * 1024,
+    'llm-invocation-cache-max-bytes': None, # e.g. 2 * 1024 ** 3, None disables the size budget
+    'llm-invocation-cache-max-age': None, # seconds since the last access, None disables the TTL
+    'llm-invocation-cache-max-variants': None, # newest `-<n>` variants kept per prompt, None keeps all
+    'llm-invocation-cache-gc-batch': 100, # max entries evicted after each cache write
+    'llm-invocation-cache-flush-batch': 100, # cache hits and misses buffered before they are written to the index
+    'api-url': os.environ.get('OPENROUTER_API_URL', 'https://openrouter.ai/api/v1'),
     'openrouter-api-key': os.environ['OPENROUTER_API_KEY'],
     'default-temp': 0,
     'default-sample-size': 1,
+    'max-sample-size': 10,
     'default-improvement-iterations': 0,
-    'valid-models': ['google/gemini-2.0-flash-lite-preview-02-05:free', 'minimax/minimax-m2:free'],
+    # model -> adapter class, imported only when the model is first used. None uses the generic OpenRouterAdapter
+    'models': {
+        'google/gemini-2.0-flash-lite-preview-02-05:free': 'src.llm.gemini.GeminiFlashLite2',
+        'minimax/minimax-m2:free': 'src.llm.minmax.MinMaxM2',
+    },
     'default-model': 'minimax/minimax-m2:free',
     'max-iterations': 10,
+    'feedback-max-error-lines': 15, # error lines per failing test sent back in improvement iterations
+    'improvement-patience': 2, # stop improving after this many iterations without more passing tests
+    'max-concurrent-requests': 8,
+    # batch jobs get their initial responses over concurrent async requests before generating tests
+    'prefetch-initial-responses': True,
+    # stream responses and stop them once a sample's test code block is complete. Such samples are cached as
+    # truncated, and non-streaming reads replace them with complete responses
+    'stream-responses': False,
+    'max-response-chars': 60000, # streamed samples longer than this are cancelled, None disables the limit
+    'requests-per-minute': 20, # client-side limits shared by all adapters, None disables them
+    'tokens-per-minute': None,
+    'max-retries': 5, # retries on 429, 5xx and connection errors
+    'retry-base-delay': 1,
+    'retry-max-delay': 60,
+    'max-connections': 32, # connection pool shared by all adapters using the same API URL
+    'max-keepalive-connections': 16,
+    'keepalive-expiry': 60,
     'prompt-template-dir': 'prompt_templates',
 }
+llm['valid-models'] = list(llm['models'])
+
+test_runner = {
+    'max-llm-workers': 8, # targets generating prompts or waiting for the LLM at the same time in batch mode
+    'max-test-workers': os.cpu_count() or 1, # pytest processes running generated tests at the same time
+    'runner-backend': 'forkserver', # 'forkserver' forks test runs from a warm worker, 'subprocess' starts interpreters
+    # modules imported once by the warm worker instead of by every test run. Forked runs import main.py again
+    # (multiprocessing does so for the launching script), so its imports are preloaded too
+    'warm-worker-preload': ['gpiozero', 'gpiozero.pins.mock', 'hypothesis', '_hypothesis_pytestplugin', 'pytest',
+                            'pytest_jsonreport.plugin', 'src.tgen.test_runner', 'src.tgen.pytest_plugin',
+                            'src.llm.async_driver', 'src.llm.model_registry', 'src.tgen.job_ledger',
+                            'src.tgen.manifest', 'src.tgen.scheduler', 'src.tgen.test_generator'],
+    'split-tests': False, # run each test of a generated file in its own process and merge their reports
+    'test-file-timeout': 600, # seconds a generated test file may run before its pytest process is killed
+    'test-timeout': 60, # seconds a single generated test may run before it's stopped, None disables the limit
+    'result-format': 'compact', # 'compact' or 'full' pytest-json-report reports in the `_result.txt` files
+    'result-message-max-lines': 30, # error lines kept per failing test in compact results
+    'keep-full-report-on-failure': False, # write the full report instead of the compact one for files that don't pass
+    'job-ledger-file': 'cache/job_ledger.sqlite3', # progress of batch jobs, used to resume interrupted batches
+}
 
 os.environ["PYTHONHASHSEED"] = "0"
\ No newline at end of file
@@ -0,0 +1,31 @@
+import asyncio
+import src.config as conf
+from src.llm.clients import close_async_clients
+from src.llm.invocation import Prompt, Response
+from src.llm.llm_adapter import LLMAdapter
+
+
+async def get_responses_async(llm: LLMAdapter, prompts: list[Prompt], max_concurrency: int | None = None,
+                              return_exceptions: bool = False) -> list[Response | BaseException]:
+    """Gets the responses to all prompts with at most `max_concurrency` requests in flight. Identical prompts share a
+    single invocation, also with any thread of the same adapter asking for them, when responses come from the cache."""
+    semaphore = asyncio.Semaphore(max_concurrency or conf.llm['max-concurrent-requests'])
+
+    async def get_response(prompt: Prompt) -> Response:
+        async with semaphore:
+            return await llm.get_response_async(prompt)
+
+    return list(await asyncio.gather(*[llm.get_shared_response_async(p, get_response) for p in prompts],
+                                     return_exceptions=return_exceptions))
+
+
+def get_responses(llm: LLMAdapter, prompts: list[Prompt], max_concurrency: int | None = None,
+                  return_exceptions: bool = False) -> list[Response | BaseException]:
+    """Runs `get_responses_async` in a new event loop, closing the clients opened for it once it's done."""
+    async def run() -> list[Response | BaseException]:
+        try:
+            return await get_responses_async(llm, prompts, max_concurrency, return_exceptions)
+        finally:
+            await close_async_clients()
+
+    return asyncio.run(run())
@@ -0,0 +1,53 @@
+import asyncio
+import threading
+import weakref
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+from src.config import llm
+
+_clients: dict[tuple[str, str], OpenAI] = {}
+# Async connections can't outlive the event loop that opened them, so async clients are pooled per loop
+_async_clients: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[tuple[str, str], AsyncOpenAI]] = \
+    weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+
+def connection_limits() -> httpx.Limits:
+    return httpx.Limits(max_connections=llm['max-connections'],
+                        max_keepalive_connections=llm['max-keepalive-connections'],
+                        keepalive_expiry=llm['keepalive-expiry'])
+
+
+def get_client(base_url: str = llm['api-url'], api_key: str = llm['openrouter-api-key']) -> OpenAI:
+    """Returns the process-wide client for `base_url`, whose keep-alive connection pool is shared by all adapters."""
+    with _clients_lock:
+        if (base_url, api_key) not in _clients:
+            _clients[(base_url, api_key)] = OpenAI(
+                base_url=base_url,
+                api_key=api_key,
+                max_retries=0,
+                http_client=DefaultHttpxClient(limits=connection_limits()),
+            )
+        return _clients[(base_url, api_key)]
+
+
+def get_async_client(base_url: str = llm['api-url'], api_key: str = llm['openrouter-api-key']) -> AsyncOpenAI:
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        clients = _async_clients.setdefault(loop, {})
+        if (base_url, api_key) not in clients:
+            clients[(base_url, api_key)] = AsyncOpenAI(
+                base_url=base_url,
+                api_key=api_key,
+                max_retries=0,
+                http_client=DefaultAsyncHttpxClient(limits=connection_limits()),
+            )
+        return clients[(base_url, api_key)]
+
+
+async def close_async_clients():
+    """Closes the async clients of the running loop, whose connections would otherwise be left open when it ends."""
+    with _clients_lock:
+        clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.close()
@@ -4,53 +4,107 @@ from typing import List
 import json
 import hashlib
 
+
+def public_fields(o) -> dict:
+    # Used as json.dumps default, so memoized digests never end up in cache files or legacy hashes
+    return {k: v for k, v in o.__dict__.items() if not k.startswith('_')}
+
+
 class Prompt:
     class Message:
         def __init__(self, role: str, content: str):
             self.role = role
             self.content = content
 
+        def __setattr__(self, name, value):
+            super().__setattr__(name, value)
+            if name != '_digest':
+                super().__setattr__('_digest', None)
+
+        def digest(self) -> bytes:
+            if self._digest is None:
+                h = hashlib.blake2b(digest_size=16)
+                h.update(self.role.encode('utf-8'))
+                h.update(b'\0')
+                h.update(self.content.encode('utf-8'))
+                self._digest = h.digest()
+            return self._digest
+
         @staticmethod
         def load_from_json(j):
             return Prompt.Message(j['role'], j['content'])
 
     def __init__(self, messages: List[Message], temp: float = llm['default-temp'],
-                 sample_size: int = llm['default-sample-size'], model: str = llm['default-model']):
+                 sample_size: int = llm['default-sample-size'], model: str = llm['default-model'], variant: int = 0):
         self.messages = messages
         self.temp = temp
         self.sample_size = sample_size
         self.model = model
+        # Selects the cached `-<variant>` invocation of the prompt, e.g. a separate one per repetition of a job. Not
+        # part of the hash or of the cache file
+        self._variant = variant
+
+    @property
+    def variant(self) -> int:
+        return self._variant
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name != '_hash':
+            super().__setattr__('_hash', None)
 
     def hash(self):
-        return hashlib.md5(str(json.dumps(self, default=lambda o: o.__dict__)).encode('utf-8')).hexdigest()
+        # Message digests are memoized per message, so re-hashing only touches messages that changed
+        digests = tuple(m.digest() for m in self.messages)
+        if self._hash is None or self._hash[0] != digests:
+            h = hashlib.blake2b(digest_size=16)
+            for param in (str(self.model), repr(float(self.temp)), str(self.sample_size)):
+                h.update(param.encode('utf-8'))
+                h.update(b'\0')
+            for digest in digests:
+                h.update(digest)
+            self._hash = (digests, h.hexdigest())
+        return self._hash[1]
+
+    def legacy_hash(self):
+        # MD5 of the serialized prompt, which keyed the cache before hash() was introduced
+        return hashlib.md5(str(json.dumps(self, default=public_fields)).encode('utf-8')).hexdigest()
 
     @staticmethod
     def load_from_json(j):
         return Prompt([Prompt.Message.load_from_json(m) for m in j['messages']],
                       j['temp'],
-                      j['sample_size'])
+                      j['sample_size'],
+                      j.get('model', llm['default-model']))
 
 class Response:
     class Sample:
-        def __init__(self, content: str):
+        def __init__(self, content: str, truncated: bool = False):
             self.content = content
+            # Set when streaming stopped the sample at its test code block, before the model finished it
+            self.truncated = truncated
 
         @staticmethod
         def load_from_json(j):
-            return Response.Sample(j['content'])
+            return Response.Sample(j['content'], j.get('truncated', False))
 
     def __init__(self, samples: List[Sample]):
         self.samples = samples
 
+    @property
+    def truncated(self) -> bool:
+        return any(s.truncated for s in self.samples)
+
     @staticmethod
     def load_from_json(j):
         return Response([Response.Sample.load_from_json(s) for s in j['samples']])
 
 class Invocation:
-    def __init__(self, prompt: Prompt, response: Response, current_time: float = time.time()):
+    def __init__(self, prompt: Prompt, response: Response, current_time: float | None = None):
         self.prompt = prompt
         self.response = response
-        self.invocation_time = current_time
+        # Resolved here, as a `time.time()` default would be evaluated only once, when the module is imported
+        self.invocation_time = time.time() if current_time is None else current_time
 
     @staticmethod
     def load_from_json(j):
@@ -0,0 +1,611 @@
+import os, json, re, logging
+import atexit
+import gzip
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import src.config as conf
+from src.llm.invocation import Invocation, Prompt, public_fields
+
+CACHE_FILE_PATTERN = re.compile(r'^(?P<hash>[0-9a-f]{32})-(?P<variant>\d+)\.json(?P<suffix>\.gz|\.zst)?$')
+COMPRESSION_SUFFIXES = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compressed cache files require the zstandard package (pip install zstandard)")
+    return zstandard
+
+
+def _read_bytes(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if path.endswith('.gz'):
+        return gzip.decompress(data)
+    elif path.endswith('.zst'):
+        return _zstd().ZstdDecompressor().decompress(data)
+    return data
+
+
+def _write_bytes(path: str, data: bytes, compression: str | None):
+    match compression:
+        case None:
+            pass
+        case 'gzip':
+            data = gzip.compress(data)
+        case 'zstd':
+            data = _zstd().ZstdCompressor().compress(data)
+        case _:
+            raise ValueError(f"Cache compression {compression} is not supported")
+
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read_cache_file(path: str) -> dict:
+    return json.loads(_read_bytes(path))
+
+
+def write_cache_file(path: str, obj, compression: str | None):
+    _write_bytes(path, json.dumps(obj, default=public_fields).encode('utf-8'), compression)
+
+
+class BlobStore:
+    """Content-addressed store for prompt message bodies, so identical bodies are only written once."""
+
+    def __init__(self, blob_dir: str, compression: str | None):
+        self.blob_dir = blob_dir
+        self.compression = compression
+
+    def find(self, digest: str) -> str | None:
+        for suffix in COMPRESSION_SUFFIXES.values():
+            path = os.path.join(self.blob_dir, digest[:2], f"{digest}.txt{suffix}")
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def put(self, content: str) -> tuple[str, int]:
+        data = content.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.find(digest)
+        if path is None:
+            path = os.path.join(self.blob_dir, digest[:2], f"{digest}.txt{COMPRESSION_SUFFIXES[self.compression]}")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _write_bytes(path, data, self.compression)
+        return digest, os.path.getsize(path)
+
+    def get(self, digest: str) -> str:
+        path = self.find(digest)
+        if path is None:
+            raise FileNotFoundError(f"Prompt blob {digest} is missing from {self.blob_dir}")
+        return _read_bytes(path).decode('utf-8')
+
+    def recompress(self) -> list[tuple[str, int]]:
+        """Rewrites every blob that is not stored with the configured compression and returns their (digest, size)."""
+        suffix = COMPRESSION_SUFFIXES[self.compression]
+        rewritten = []
+        for dirpath, _, filenames in list(os.walk(self.blob_dir)):
+            for filename in filenames:
+                digest, _, file_suffix = filename.partition('.txt')
+                if file_suffix == suffix or file_suffix not in COMPRESSION_SUFFIXES.values():
+                    continue
+                old_path = os.path.join(dirpath, filename)
+                new_path = os.path.join(dirpath, f"{digest}.txt{suffix}")
+                _write_bytes(new_path, _read_bytes(old_path), self.compression)
+                os.remove(old_path)
+                rewritten.append((digest, os.path.getsize(new_path)))
+        return rewritten
+
+
+class CacheIndex:
+    """Persistent prompt hash -> cache file map, stored in an SQLite database next to the cache files."""
+
+    def __init__(self, cache_dir: str, index_file: str,
+                 flush_batch: int = conf.llm['llm-invocation-cache-flush-batch']):
+        self.cache_dir = cache_dir
+        self.index_file = index_file
+        self.lock = threading.Lock()
+        # Accesses and lookup counts are written in batches, as a committed write per cache hit costs more than the
+        # hit itself, especially on a network file system
+        self.flush_batch = flush_batch
+        self.pending_touches: dict[str, float] = {}
+        self.pending_lookups: Counter[str] = Counter()
+
+        self.is_new = not os.path.isfile(index_file)
+        self.conn = sqlite3.connect(index_file, timeout=30, check_same_thread=False)
+        # WAL avoids an fsync per committed lookup/touch and lets concurrent processes read while one writes
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS invocations ('
+                          'prompt_hash TEXT NOT NULL, '
+                          'variant INTEGER NOT NULL, '
+                          'path TEXT NOT NULL, '
+                          'model TEXT, '
+                          'size INTEGER, '
+                          'created REAL, '
+                          'last_access REAL, '
+                          'PRIMARY KEY (prompt_hash, variant))')
+        columns = [c[1] for c in self.conn.execute('PRAGMA table_info(invocations)')]
+        if 'last_access' not in columns:
+            self.conn.execute('ALTER TABLE invocations ADD COLUMN last_access REAL')
+            self.conn.execute('UPDATE invocations SET last_access = created')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS blobs ('
+                          'digest TEXT PRIMARY KEY, '
+                          'size INTEGER, '
+                          'refs INTEGER NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS counters ('
+                          'name TEXT PRIMARY KEY, '
+                          'value INTEGER NOT NULL)')
+        self.conn.commit()
+
+    def lookup(self, prompt_hash: str, variant: int | None = None) -> list[str]:
+        with self.lock:
+            if variant is None:
+                rows = self.conn.execute('SELECT path FROM invocations WHERE prompt_hash = ? ORDER BY variant',
+                                         (prompt_hash,)).fetchall()
+            else:
+                rows = self.conn.execute('SELECT path FROM invocations WHERE prompt_hash = ? AND variant = ?',
+                                         (prompt_hash, variant)).fetchall()
+        return [os.path.join(self.cache_dir, r[0]) for r in rows]
+
+    def next_variant(self, prompt_hash: str) -> int:
+        with self.lock:
+            row = self.conn.execute('SELECT MAX(variant) FROM invocations WHERE prompt_hash = ?',
+                                    (prompt_hash,)).fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def add(self, prompt_hash: str, variant: int, path: str, model: str | None, size: int, created: float):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO invocations VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (prompt_hash, variant, os.path.relpath(path, self.cache_dir), model, size, created,
+                               created))
+            self.conn.commit()
+
+    def add_many(self, rows: list[tuple[str, int, str, str | None, int, float]]) -> int:
+        with self.lock:
+            changes = self.conn.total_changes
+            self.conn.executemany('INSERT OR IGNORE INTO invocations VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                  [(h, v, os.path.relpath(p, self.cache_dir), m, size, created, created)
+                                   for h, v, p, m, size, created in rows])
+            self.conn.commit()
+            return self.conn.total_changes - changes
+
+    def indexed_paths(self) -> set[str]:
+        with self.lock:
+            rows = self.conn.execute('SELECT path FROM invocations').fetchall()
+        return {os.path.join(self.cache_dir, r[0]) for r in rows}
+
+    def touch(self, path: str):
+        with self.lock:
+            self.pending_touches[os.path.relpath(path, self.cache_dir)] = time.time()
+            self.flush_if_full()
+
+    def total_bytes(self) -> int:
+        with self.lock:
+            invocations = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM invocations').fetchone()[0]
+            blobs = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs WHERE refs > 0').fetchone()[0]
+        return invocations + blobs
+
+    def least_recently_used(self, limit: int) -> list[tuple[str, str]]:
+        with self.lock:
+            rows = self.conn.execute('SELECT prompt_hash, path FROM invocations ORDER BY last_access LIMIT ?',
+                                     (limit,)).fetchall()
+        return [(h, os.path.join(self.cache_dir, p)) for h, p in rows]
+
+    def accessed_before(self, timestamp: float) -> list[tuple[str, str]]:
+        with self.lock:
+            rows = self.conn.execute('SELECT prompt_hash, path FROM invocations WHERE last_access < ?',
+                                     (timestamp,)).fetchall()
+        return [(h, os.path.join(self.cache_dir, p)) for h, p in rows]
+
+    def excess_variants(self, max_variants: int) -> list[tuple[str, str]]:
+        """Returns all but the `max_variants` most recently written variants of each prompt."""
+        with self.lock:
+            # Variants are written out of order when repetitions fill them in, so the write time decides
+            rows = self.conn.execute('SELECT prompt_hash, path FROM ('
+                                     'SELECT prompt_hash, path, ROW_NUMBER() OVER '
+                                     '(PARTITION BY prompt_hash ORDER BY created DESC, variant DESC) AS rn '
+                                     'FROM invocations) '
+                                     'WHERE rn > ?', (max_variants,)).fetchall()
+        return [(h, os.path.join(self.cache_dir, p)) for h, p in rows]
+
+    def entry_size(self, path: str) -> int:
+        with self.lock:
+            row = self.conn.execute('SELECT size FROM invocations WHERE path = ?',
+                                    (os.path.relpath(path, self.cache_dir),)).fetchone()
+        return row[0] or 0 if row else 0
+
+    def add_blob_refs(self, blobs: list[tuple[str, int]]):
+        with self.lock:
+            self.conn.executemany('INSERT INTO blobs VALUES (?, ?, 1) ON CONFLICT(digest) DO UPDATE SET refs = refs + 1',
+                                  blobs)
+            self.conn.commit()
+
+    def record_lookup(self, hit: bool):
+        with self.lock:
+            self.pending_lookups['hits' if hit else 'misses'] += 1
+            self.flush_if_full()
+
+    def flush_if_full(self):
+        # Called with the lock held
+        if len(self.pending_touches) + sum(self.pending_lookups.values()) >= self.flush_batch:
+            self.write_pending()
+
+    def write_pending(self):
+        # Called with the lock held
+        if not self.pending_touches and not self.pending_lookups:
+            return
+        self.conn.executemany('UPDATE invocations SET last_access = ? WHERE path = ?',
+                              [(accessed, path) for path, accessed in self.pending_touches.items()])
+        self.conn.executemany('INSERT INTO counters VALUES (?, ?) ON CONFLICT(name) '
+                              'DO UPDATE SET value = value + excluded.value', list(self.pending_lookups.items()))
+        self.conn.commit()
+        self.pending_touches.clear()
+        self.pending_lookups.clear()
+
+    def flush(self):
+        """Writes the buffered accesses and lookup counts to the index."""
+        with self.lock:
+            self.write_pending()
+
+    def stats(self, top: int) -> dict:
+        with self.lock:
+            self.write_pending()
+            entries, entry_bytes = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) '
+                                                     'FROM invocations').fetchone()
+            blobs, blob_bytes = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) '
+                                                  'FROM blobs WHERE refs > 0').fetchone()
+            counters = dict(self.conn.execute('SELECT name, value FROM counters').fetchall())
+            models = self.conn.execute('SELECT model, COUNT(*), COALESCE(SUM(size), 0) FROM invocations '
+                                       'GROUP BY model ORDER BY COUNT(*) DESC').fetchall()
+            oldest = self.conn.execute('SELECT path, created, size FROM invocations '
+                                       'ORDER BY created LIMIT ?', (top,)).fetchall()
+            largest = self.conn.execute('SELECT path, created, size FROM invocations '
+                                        'ORDER BY size DESC LIMIT ?', (top,)).fetchall()
+
+        return {'entries': entries, 'entry_bytes': entry_bytes, 'blobs': blobs, 'blob_bytes': blob_bytes,
+                'hits': counters.get('hits', 0), 'misses': counters.get('misses', 0),
+                'models': models, 'oldest': oldest, 'largest': largest}
+
+    def release_blobs(self, digests: list[str]) -> list[tuple[str, int]]:
+        """Drops one reference to each blob and returns the (digest, size) of blobs that are no longer referenced."""
+        with self.lock:
+            self.conn.executemany('UPDATE blobs SET refs = refs - 1 WHERE digest = ?', [(d,) for d in digests])
+            unreferenced = self.conn.execute('SELECT digest, size FROM blobs WHERE refs <= 0').fetchall()
+            self.conn.execute('DELETE FROM blobs WHERE refs <= 0')
+            self.conn.commit()
+        return unreferenced
+
+    def move(self, old_path: str, new_path: str, size: int | None = None):
+        with self.lock:
+            self.conn.execute('UPDATE invocations SET path = ?, size = COALESCE(?, size) WHERE path = ?',
+                              (os.path.relpath(new_path, self.cache_dir), size,
+                               os.path.relpath(old_path, self.cache_dir)))
+            self.conn.commit()
+
+    def set_blob_size(self, digest: str, size: int):
+        with self.lock:
+            self.conn.execute('UPDATE blobs SET size = ? WHERE digest = ?', (size, digest))
+            self.conn.commit()
+
+    def remove(self, path: str):
+        with self.lock:
+            self.conn.execute('DELETE FROM invocations WHERE path = ?', (os.path.relpath(path, self.cache_dir),))
+            self.conn.commit()
+
+
+class MemoryCache:
+    """Bounded in-process LRU of deserialized invocations, limited both by entry count and approximate size."""
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # (prompt hash, variant) -> (invocation, approximate size, cache file)
+        self.entries: OrderedDict[tuple[str, int], tuple[Invocation, int, str]] = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def approximate_size(invocation: Invocation) -> int:
+        return (sum(len(m.content) for m in invocation.prompt.messages)
+                + sum(len(s.content or '') for s in invocation.response.samples))
+
+    def get(self, key: tuple[str, int]) -> tuple[Invocation, str] | None:
+        """Returns the invocation and the path of the cache file it was loaded from or saved to."""
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            invocation, _, path = self.entries[key]
+            return invocation, path
+
+    def put(self, key: tuple[str, int], invocation: Invocation, path: str):
+        size = self.approximate_size(invocation)
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (invocation, size, path)
+            self.total_bytes += size
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                self.total_bytes -= self.entries.popitem(last=False)[1][1]
+
+    def hit_ratio(self) -> float | None:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+    def discard(self, key: tuple[str, int]):
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+
+
+class InvocationCache:
+    def __init__(self, cache_dir: str, index_file: str, shard_chars: int = conf.llm['llm-invocation-cache-shard-chars'],
+                 compression: str | None = conf.llm['llm-invocation-cache-compression'],
+                 dedup_prompts: bool = conf.llm['llm-invocation-cache-dedup-prompts'],
+                 memory_entries: int = conf.llm['llm-invocation-memory-cache-entries'],
+                 memory_bytes: int = conf.llm['llm-invocation-memory-cache-bytes'],
+                 max_bytes: int | None = conf.llm['llm-invocation-cache-max-bytes'],
+                 max_age: float | None = conf.llm['llm-invocation-cache-max-age'],
+                 max_variants: int | None = conf.llm['llm-invocation-cache-max-variants'],
+                 gc_batch: int = conf.llm['llm-invocation-cache-gc-batch']):
+        if compression not in COMPRESSION_SUFFIXES:
+            raise ValueError(f"Cache compression {compression} is not supported")
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.shard_chars = shard_chars
+        self.compression = compression
+        self.dedup_prompts = dedup_prompts
+        self.index = CacheIndex(cache_dir, index_file)
+        self.blobs = BlobStore(os.path.join(cache_dir, 'blobs'), compression)
+        self.memory = MemoryCache(memory_entries, memory_bytes)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_variants = max_variants
+        self.gc_batch = gc_batch
+
+        # The memory LRU only lives as long as the process, so its counters are reported when the process exits,
+        # along with the index updates still buffered
+        atexit.register(self.index.flush)
+        atexit.register(self.log_memory_stats)
+
+        if self.index.is_new:
+            imported = self.import_existing()
+            logging.info(f"Created cache index {index_file} with {imported} existing invocations")
+
+    def import_existing(self) -> int:
+        """Imports the `<md5>-<n>.json` files under the cache dir that are not indexed yet."""
+        indexed = self.index.indexed_paths()
+        rows, blobs = [], []
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                match = CACHE_FILE_PATTERN.match(filename)
+                path = os.path.join(dirpath, filename)
+                if not match or path in indexed:
+                    continue
+                try:
+                    j = read_cache_file(path)
+                    model = j['prompt'].get('model')
+                    created = j.get('invocation_time', os.path.getmtime(path))
+                    digests = [m['content_ref'] for m in j['prompt']['messages'] if 'content_ref' in m]
+                except (OSError, ValueError, KeyError, ImportError) as e:
+                    logging.warning(f"Skipping unreadable cache file {path}: {e}")
+                    continue
+                rows.append((match['hash'], int(match['variant']), path, model, os.path.getsize(path), created))
+                for digest in digests:
+                    blob_path = self.blobs.find(digest)
+                    blobs.append((digest, os.path.getsize(blob_path) if blob_path else 0))
+
+        imported = self.index.add_many(rows)
+        self.index.add_blob_refs(blobs)
+        return imported
+
+    def log_memory_stats(self):
+        hit_ratio = self.memory.hit_ratio()
+        if hit_ratio is not None:
+            logging.info(f"In-memory cache of {self.cache_dir}: {self.memory.hits} hits, {self.memory.misses} misses,"
+                         f" hit ratio {hit_ratio:.1%}, {len(self.memory.entries)} entries ({self.memory.total_bytes}"
+                         f" bytes)")
+
+    def entry_path(self, prompt_hash: str, variant: int, suffix: str = None) -> str:
+        if suffix is None:
+            suffix = COMPRESSION_SUFFIXES[self.compression]
+        shard_dir = os.path.join(self.cache_dir, prompt_hash[:self.shard_chars]) if self.shard_chars else self.cache_dir
+        return os.path.join(shard_dir, f"{prompt_hash}-{variant}.json{suffix}")
+
+    def load(self, prompt: Prompt) -> Invocation | None:
+        prompt_hash = prompt.hash()
+        cached = self.memory.get((prompt_hash, prompt.variant))
+        if cached:
+            # Entries served from memory are still in use, so they must not age out of the cache on disk
+            invocation, path = cached
+            self.index.touch(path)
+            return invocation
+
+        for path in (self.index.lookup(prompt_hash, prompt.variant)
+                     or self.index.lookup(prompt.legacy_hash(), prompt.variant)):
+            try:
+                invocation = Invocation.load_from_json(self.resolve_blobs(read_cache_file(path)))
+                self.index.touch(path)
+                self.memory.put((prompt_hash, prompt.variant), invocation, path)
+                return invocation
+            except FileNotFoundError:
+                logging.warning(f"Cache file {path} is indexed but missing, dropping it from the index")
+                self.index.remove(path)
+
+        return None
+
+    def resolve_blobs(self, j: dict) -> dict:
+        for m in j['prompt']['messages']:
+            if 'content_ref' in m:
+                m['content'] = self.blobs.get(m.pop('content_ref'))
+        return j
+
+    def save(self, invocation: Invocation, skip_if_cached: bool, replace: bool = False):
+        """Saves the invocation, unless `skip_if_cached` is set and its variant is cached already. With `replace`, the
+        cached variant is overwritten instead, e.g. a truncated streamed response by the complete one."""
+        prompt_hash = invocation.prompt.hash()
+        if skip_if_cached:
+            variant = invocation.prompt.variant
+            cached = self.index.lookup(prompt_hash, variant)
+            if cached and not replace:
+                # It is already loaded from cache, no reason to save it again
+                return
+            for path in cached:
+                self.evict(prompt_hash, path)
+        else:
+            # Invocations made without reading the cache are kept as new variants
+            variant = self.index.next_variant(prompt_hash)
+        cache_file = self.entry_path(prompt_hash, variant)
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        if self.dedup_prompts:
+            messages, blobs = [], []
+            for m in invocation.prompt.messages:
+                digest, size = self.blobs.put(m.content)
+                messages.append({'role': m.role, 'content_ref': digest})
+                blobs.append((digest, size))
+            write_cache_file(cache_file, {**public_fields(invocation),
+                                          'prompt': {**public_fields(invocation.prompt), 'messages': messages}},
+                             self.compression)
+            self.index.add_blob_refs(blobs)
+        else:
+            write_cache_file(cache_file, invocation, self.compression)
+
+        # The entry's age counts from when it was written, whatever time the invocation itself carries
+        self.index.add(prompt_hash, variant, cache_file, invocation.prompt.model, os.path.getsize(cache_file),
+                       time.time())
+        if variant == invocation.prompt.variant:
+            self.memory.put((prompt_hash, variant), invocation, cache_file)
+
+        self.gc(self.gc_batch)
+
+    def evict(self, prompt_hash: str, path: str) -> int:
+        """Removes a cache entry and the blobs only it referenced, returning the number of bytes freed."""
+        freed = self.index.entry_size(path)
+        try:
+            digests = [m['content_ref'] for m in read_cache_file(path)['prompt']['messages'] if 'content_ref' in m]
+            os.remove(path)
+        except (OSError, ValueError, KeyError, ImportError) as e:
+            logging.warning(f"Could not read evicted cache file {path}: {e}")
+            digests = []
+
+        self.index.remove(path)
+        match = CACHE_FILE_PATTERN.match(os.path.basename(path))
+        if match:
+            self.memory.discard((prompt_hash, int(match['variant'])))
+        for digest, size in self.index.release_blobs(digests):
+            blob_path = self.blobs.find(digest)
+            if blob_path:
+                os.remove(blob_path)
+            freed += size or 0
+        return freed
+
+    def gc(self, max_evictions: int | None = None) -> int:
+        """Evicts expired entries, surplus variants and least recently used entries until the cache fits its budget.
+
+        At most `max_evictions` entries are evicted per call, so it can run incrementally after each write."""
+        # Eviction goes by the last accesses, and a write is a good moment to store the buffered ones anyway
+        self.index.flush()
+        if self.max_age is None and self.max_variants is None and self.max_bytes is None:
+            return 0
+
+        candidates = []
+        if self.max_age is not None:
+            candidates += self.index.accessed_before(time.time() - self.max_age)
+        if self.max_variants is not None:
+            candidates += self.index.excess_variants(self.max_variants)
+
+        evicted = 0
+        for prompt_hash, path in dict.fromkeys(candidates):
+            if max_evictions is not None and evicted >= max_evictions:
+                return evicted
+            self.evict(prompt_hash, path)
+            evicted += 1
+
+        if self.max_bytes is not None:
+            total = self.index.total_bytes()
+            while total > self.max_bytes and (max_evictions is None or evicted < max_evictions):
+                batch = self.index.least_recently_used(min(self.gc_batch, max_evictions - evicted)
+                                                       if max_evictions is not None else self.gc_batch)
+                if not batch:
+                    break
+                for prompt_hash, path in batch:
+                    if total <= self.max_bytes:
+                        break
+                    total -= self.evict(prompt_hash, path)
+                    evicted += 1
+
+        if evicted:
+            logging.info(f"Evicted {evicted} invocations from the cache at {self.cache_dir}")
+        return evicted
+
+    def reshard(self) -> int:
+        """Moves every cache file to its path under the current shard layout, without rewriting its content."""
+        moved = 0
+        for dirpath, _, filenames in list(os.walk(self.cache_dir)):
+            for filename in filenames:
+                match = CACHE_FILE_PATTERN.match(filename)
+                if not match:
+                    continue
+                old_path = os.path.join(dirpath, filename)
+                new_path = self.entry_path(match['hash'], int(match['variant']), match['suffix'] or '')
+                if os.path.abspath(old_path) == os.path.abspath(new_path):
+                    continue
+                os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                os.replace(old_path, new_path)
+                self.index.move(old_path, new_path)
+                moved += 1
+
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir, topdown=False):
+            if dirpath != self.cache_dir and not dirnames and not filenames:
+                os.rmdir(dirpath)
+        return moved
+
+    def recompress(self) -> int:
+        """Rewrites every cache file and prompt blob that is not stored with the configured compression."""
+        rewritten = 0
+        for dirpath, _, filenames in list(os.walk(self.cache_dir)):
+            for filename in filenames:
+                match = CACHE_FILE_PATTERN.match(filename)
+                if not match or (match['suffix'] or '') == COMPRESSION_SUFFIXES[self.compression]:
+                    continue
+                old_path = os.path.join(dirpath, filename)
+                new_path = self.entry_path(match['hash'], int(match['variant']))
+                os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                write_cache_file(new_path, read_cache_file(old_path), self.compression)
+                self.index.move(old_path, new_path, os.path.getsize(new_path))
+                os.remove(old_path)
+                rewritten += 1
+
+        for digest, size in self.blobs.recompress():
+            self.index.set_blob_size(digest, size)
+            rewritten += 1
+        return rewritten
+
+
+_caches: dict[str, InvocationCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_invocation_cache(cache_dir: str = None) -> InvocationCache:
+    """Returns the process-wide cache for `cache_dir`, so its index is only opened once per process."""
+    cache_dir = cache_dir or conf.llm['llm-invocation-cache-dir']
+    with _caches_lock:
+        if cache_dir not in _caches:
+            _caches[cache_dir] = InvocationCache(cache_dir,
+                                                 os.path.join(cache_dir, conf.llm['llm-invocation-index-file']))
+        return _caches[cache_dir]
@@ -1,8 +1,11 @@
-import os, json, logging
-import uuid
-
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Awaitable, Callable
 import src.config as conf
-from src.llm.invocation import Invocation, Prompt
+from src.llm.invocation import Invocation, Prompt, Response
+from src.llm.invocation_cache import get_invocation_cache
+from src.llm.streaming import CodeBlockDetector
 
 
 class LLMAdapter:
@@ -10,36 +13,98 @@ class LLMAdapter:
         self.cache_dir = conf.llm['llm-invocation-cache-dir']
         self.read_from_cache = read_from_cache
         self.save_to_cache = save_to_cache
+        self.cache = get_invocation_cache(self.cache_dir)
+        self.in_flight: dict[tuple[str, int], Future] = {}
+        self.in_flight_lock = threading.Lock()
 
     def load_cache(self, prompt: Prompt) -> Invocation | None:
         if not self.read_from_cache:
             return None
 
-        prompt_hash = prompt.hash()
-        cached_files = [f for f in os.listdir(self.cache_dir) if os.path.isfile(os.path.join(self.cache_dir, f))
-                        and prompt_hash in f]
-
-        if len(cached_files) > 0:
-            with open(os.path.join(self.cache_dir, cached_files[0]), 'r') as f:
-                return Invocation.load_from_json(json.load(f))
+        invocation = self.cache.load(prompt)
+        self.cache.index.record_lookup(invocation is not None)
+        return invocation
 
-        return None
-
-    def save_cache(self, invocation: Invocation):
+    def save_cache(self, invocation: Invocation, replace: bool = False):
         if not self.save_to_cache:
             return
 
-        prompt_hash = invocation.prompt.hash()
-        cached_files = [f for f in os.listdir(self.cache_dir) if os.path.isfile(os.path.join(self.cache_dir, f))
-                        and prompt_hash in f]
+        self.cache.save(invocation, skip_if_cached=self.read_from_cache, replace=replace)
 
-        if len(cached_files) > 0 and self.read_from_cache:
-            # It is already loaded from cache, no reason to save it again
-            return
+    def claim_in_flight(self, prompt: Prompt) -> tuple[Future, bool]:
+        """Returns the future of the invocation of an identical prompt that is already in flight, or registers a new
+        one, in which case the caller owns it and must pass it to `finish_in_flight`."""
+        key = (prompt.hash(), prompt.variant)
+        with self.in_flight_lock:
+            in_flight = self.in_flight.get(key)
+            if in_flight is not None:
+                return in_flight, False
+            future = self.in_flight[key] = Future()
+            return future, True
+
+    def finish_in_flight(self, prompt: Prompt, future: Future, response: Response | None,
+                         error: BaseException | None = None):
+        with self.in_flight_lock:
+            del self.in_flight[(prompt.hash(), prompt.variant)]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(response)
+
+    def get_shared_response(self, prompt: Prompt, get_response: Callable[[Prompt], Response]) -> Response:
+        """Calls `get_response(prompt)`, except that callers asking for an identical prompt and variant at the same time
+        wait for the invocation that is already in flight, as theirs would be served from the cache anyway."""
+        if not self.read_from_cache:
+            # Every prompt should get its own invocation when the cache is bypassed
+            return get_response(prompt)
 
-        cache_file = os.path.join(self.cache_dir, f"{prompt_hash}-{len(cached_files)}.json")
-        with open(cache_file, 'w') as f:
-            json.dump(invocation, f, default=lambda o: o.__dict__)
+        future, owner = self.claim_in_flight(prompt)
+        if not owner:
+            return future.result()
+        try:
+            response = get_response(prompt)
+        except BaseException as e:
+            self.finish_in_flight(prompt, future, None, e)
+            raise
+        self.finish_in_flight(prompt, future, response)
+        return response
+
+    async def get_shared_response_async(self, prompt: Prompt,
+                                        get_response: Callable[[Prompt], Awaitable[Response]]) -> Response:
+        """Async counterpart of `get_shared_response`, sharing its in-flight invocations with threads and other loops."""
+        if not self.read_from_cache:
+            return await get_response(prompt)
+
+        future, owner = self.claim_in_flight(prompt)
+        if not owner:
+            return await asyncio.wrap_future(future)
+        try:
+            response = await get_response(prompt)
+        except BaseException as e:
+            self.finish_in_flight(prompt, future, None, e)
+            raise
+        self.finish_in_flight(prompt, future, response)
+        return response
 
     def get_response(self, prompt: Prompt):
-        raise NotImplementedError("This method should be implemented by subclasses")
\ No newline at end of file
+        raise NotImplementedError("This method should be implemented by subclasses")
+
+    async def get_response_async(self, prompt: Prompt):
+        raise NotImplementedError("This method should be implemented by subclasses")
+
+    def get_response_streaming(self, prompt: Prompt,
+                               on_code_block: Callable[[int, str], bool] | None = None) -> Response:
+        """Like get_response, but calls `on_code_block(sample_index, code)` for each Python block as soon as it is
+        complete. Adapters that can't stream report the blocks once the whole response has arrived."""
+        response = self.get_response(prompt)
+        self.report_code_blocks(response, on_code_block)
+        return response
+
+    @staticmethod
+    def report_code_blocks(response: Response, on_code_block: Callable[[int, str], bool] | None):
+        if not on_code_block:
+            return
+        for i, sample in enumerate(response.samples):
+            for code in CodeBlockDetector().feed((sample.content or '') + '\n'):
+                if on_code_block(i, code):
+                    break
\ No newline at end of file
@@ -0,0 +1,27 @@
+import importlib
+import threading
+import src.config as conf
+from src.llm.llm_adapter import LLMAdapter
+
+DEFAULT_ADAPTER = 'src.llm.openrouter.OpenRouterAdapter'
+
+_adapters: dict[tuple[str, bool, bool], LLMAdapter] = {}
+_adapters_lock = threading.Lock()
+
+
+def load_adapter_class(model: str) -> type[LLMAdapter]:
+    if model not in conf.llm['models']:
+        raise ValueError(f"Model {model} is not supported")
+
+    module_name, class_name = (conf.llm['models'][model] or DEFAULT_ADAPTER).rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def get_adapter(model: str, read_from_cache: bool=True, save_to_cache: bool=True) -> LLMAdapter:
+    """Returns the adapter for `model`, constructing it (and importing its module) on first use only."""
+    key = (model, read_from_cache, save_to_cache)
+    with _adapters_lock:
+        if key not in _adapters:
+            _adapters[key] = load_adapter_class(model)(read_from_cache=read_from_cache, save_to_cache=save_to_cache,
+                                                       model=model)
+        return _adapters[key]
\ No newline at end of file
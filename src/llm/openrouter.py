@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from src.config import llm
+from openai import AsyncOpenAI, APIStatusError, APIConnectionError
+from .clients import get_client, get_async_client
+from .invocation import *
+from .llm_adapter import LLMAdapter
+from .rate_limiter import get_rate_limiter
+from .streaming import CodeBlockDetector
+
+
+def is_retryable(e: Exception) -> bool:
+    return isinstance(e, APIConnectionError) or (isinstance(e, APIStatusError)
+                                                 and (e.status_code == 429 or e.status_code >= 500))
+
+
+def retry_delay(e: Exception, attempt: int) -> float:
+    # Full jitter exponential backoff, but never earlier than the provider asked us to wait
+    delay = random.uniform(0, min(llm['retry-max-delay'], llm['retry-base-delay'] * 2 ** attempt))
+    if isinstance(e, APIStatusError):
+        try:
+            delay = max(delay, float(e.response.headers.get('retry-after', 0)))
+        except ValueError:
+            pass
+    return delay
+
+
+def estimate_tokens(prompt: Prompt) -> int:
+    return sum(len(m.content) for m in prompt.messages) // 4
+
+
+class OpenRouterAdapter(LLMAdapter):
+    model: str = None
+
+    def __init__(self, read_from_cache: bool=True, save_to_cache: bool=True, model: str=None):
+        super().__init__(read_from_cache=read_from_cache, save_to_cache=save_to_cache)
+        self.model = model or self.model
+        self.client = get_client(llm['api-url'], llm['openrouter-api-key'])
+        self.rate_limiter = get_rate_limiter(llm['api-url'], llm['requests-per-minute'], llm['tokens-per-minute'])
+
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        return get_async_client(llm['api-url'], llm['openrouter-api-key'])
+
+    def completion_args(self, prompt: Prompt, n: int, stream: bool) -> dict:
+        args = {'model': self.model, 'messages': [public_fields(m) for m in prompt.messages],
+                'temperature': prompt.temp}
+        if n > 1:
+            args['n'] = n
+        if stream:
+            args['stream'] = True
+        return args
+
+    @staticmethod
+    def to_response(completion) -> Response:
+        return Response([Response.Sample(c.message.content)
+                         for c in completion.choices])
+
+    def on_completion(self, completion, estimated_tokens: int):
+        usage = getattr(completion, 'usage', None)
+        self.rate_limiter.adjust(estimated_tokens, usage.total_tokens if usage else estimated_tokens)
+
+    def on_retryable_error(self, e: Exception, attempt: int) -> float:
+        delay = retry_delay(e, attempt)
+        logging.warning(f"Request to {self.model} failed ({e}), retrying in {delay:.1f}s "
+                        f"(attempt {attempt + 1}/{llm['max-retries']})")
+        if isinstance(e, APIStatusError) and e.status_code == 429:
+            self.rate_limiter.block(delay)
+        return delay
+
+    def create_completion(self, prompt: Prompt, n: int, stream: bool = False):
+        estimated_tokens = estimate_tokens(prompt) * n
+        for attempt in range(llm['max-retries'] + 1):
+            self.rate_limiter.acquire(estimated_tokens)
+            try:
+                completion = self.client.chat.completions.create(**self.completion_args(prompt, n, stream))
+            except Exception as e:
+                if not is_retryable(e) or attempt == llm['max-retries']:
+                    raise
+                time.sleep(self.on_retryable_error(e, attempt))
+                continue
+            self.on_completion(completion, estimated_tokens)
+            return completion
+
+    async def create_completion_async(self, prompt: Prompt, n: int):
+        estimated_tokens = estimate_tokens(prompt) * n
+        for attempt in range(llm['max-retries'] + 1):
+            await self.rate_limiter.acquire_async(estimated_tokens)
+            try:
+                completion = await self.async_client.chat.completions.create(**self.completion_args(prompt, n, False))
+            except Exception as e:
+                if not is_retryable(e) or attempt == llm['max-retries']:
+                    raise
+                await asyncio.sleep(self.on_retryable_error(e, attempt))
+                continue
+            self.on_completion(completion, estimated_tokens)
+            return completion
+
+    def get_response(self, prompt: Prompt) -> Response:
+        cached_invocation = self.load_cache(prompt)
+        # A streamed response cut short at its test code block may lack what a complete one would have
+        if cached_invocation and not cached_invocation.response.truncated:
+            return cached_invocation.response
+
+        response = self.to_response(self.create_completion(prompt, prompt.sample_size))
+        self.request_missing_samples(prompt, response)
+
+        self.save_cache(Invocation(prompt, response), replace=cached_invocation is not None)
+        return response
+
+    def request_missing_samples(self, prompt: Prompt, response: Response):
+        missing = prompt.sample_size - len(response.samples)
+        if missing > 0:
+            # The provider ignored `n`, so the remaining samples are requested concurrently one by one
+            logging.info(f"{self.model} returned {len(response.samples)}/{prompt.sample_size} samples, "
+                         f"requesting {missing} more")
+            with ThreadPoolExecutor(max_workers=min(missing, llm['max-concurrent-requests'])) as executor:
+                completions = list(executor.map(lambda _: self.create_completion(prompt, 1), range(missing)))
+            response.samples += [s for c in completions for s in self.to_response(c).samples]
+
+    def get_response_streaming(self, prompt: Prompt,
+                               on_code_block: Callable[[int, str], bool] | None = None) -> Response:
+        cached_invocation = self.load_cache(prompt)
+        if cached_invocation:
+            self.report_code_blocks(cached_invocation.response, on_code_block)
+            return cached_invocation.response
+
+        contents: dict[int, list[str]] = {}
+        detectors: dict[int, CodeBlockDetector] = {}
+        lengths: dict[int, int] = {}
+        finished: set[int] = set()
+        stopped: set[int] = set()
+        runaway = False
+
+        stream = self.create_completion(prompt, prompt.sample_size, stream=True)
+        try:
+            for chunk in stream:
+                for choice in chunk.choices:
+                    i = choice.index
+                    if i in finished:
+                        continue
+                    delta = choice.delta.content or ''
+                    contents.setdefault(i, []).append(delta)
+                    lengths[i] = lengths.get(i, 0) + len(delta)
+
+                    if on_code_block and any(on_code_block(i, code)
+                                             for code in detectors.setdefault(i, CodeBlockDetector()).feed(delta)):
+                        finished.add(i)
+                        if not choice.finish_reason:
+                            stopped.add(i)
+                    elif llm['max-response-chars'] and lengths[i] > llm['max-response-chars']:
+                        logging.warning(f"Sample {i} of {self.model} exceeded {llm['max-response-chars']} chars, "
+                                        f"cancelling it")
+                        finished.add(i)
+                        runaway = True
+                    elif choice.finish_reason:
+                        finished.add(i)
+
+                if len(finished) == prompt.sample_size:
+                    # Every sample has what we need, so the trailing output isn't worth waiting for
+                    break
+        finally:
+            stream.close()
+
+        response = Response([Response.Sample(''.join(contents[i]), i in stopped) for i in sorted(contents)])
+        self.request_missing_samples(prompt, response)
+
+        if not runaway:
+            self.save_cache(Invocation(prompt, response))
+        return response
+
+    async def get_response_async(self, prompt: Prompt) -> Response:
+        # Cache lookups and writes hit SQLite and the disk, so they run off the event loop
+        cached_invocation = await asyncio.to_thread(self.load_cache, prompt)
+        if cached_invocation and not cached_invocation.response.truncated:
+            return cached_invocation.response
+
+        response = self.to_response(await self.create_completion_async(prompt, prompt.sample_size))
+        if len(response.samples) < prompt.sample_size:
+            await asyncio.to_thread(self.request_missing_samples, prompt, response)
+
+        await asyncio.to_thread(self.save_cache, Invocation(prompt, response), cached_invocation is not None)
+        return response
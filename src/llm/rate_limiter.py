@@ -0,0 +1,65 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float, now: float) -> float:
+        """Takes `amount` tokens, possibly going into debt, and returns how long the caller has to wait for them."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class RateLimiter:
+    """Client-side requests/min and tokens/min limiter, shared by all adapters talking to the same API."""
+
+    def __init__(self, requests_per_minute: float | None, tokens_per_minute: float | None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens: int) -> float:
+        with self.lock:
+            now = time.monotonic()
+            delay = max(0, self.blocked_until - now)
+            if self.requests:
+                delay = max(delay, self.requests.reserve(1, now))
+            if self.tokens:
+                delay = max(delay, self.tokens.reserve(tokens, now))
+            return delay
+
+    def acquire(self, tokens: int):
+        time.sleep(self.reserve(tokens))
+
+    async def acquire_async(self, tokens: int):
+        await asyncio.sleep(self.reserve(tokens))
+
+    def adjust(self, estimated_tokens: int, actual_tokens: int):
+        if self.tokens:
+            with self.lock:
+                self.tokens.tokens -= actual_tokens - estimated_tokens
+
+    def block(self, seconds: float):
+        # The provider throttled us, so no request should be sent by anyone until it's likely to be accepted
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+_limiters: dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(api_url: str, requests_per_minute: float | None, tokens_per_minute: float | None) -> RateLimiter:
+    with _limiters_lock:
+        if api_url not in _limiters:
+            _limiters[api_url] = RateLimiter(requests_per_minute, tokens_per_minute)
+        return _limiters[api_url]
\ No newline at end of file
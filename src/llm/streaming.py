@@ -0,0 +1,36 @@
+PYTHON_LANGUAGES = ('python', 'py', 'python3')
+
+
+class CodeBlockDetector:
+    """Incrementally finds fenced Python code blocks in a streamed LLM response."""
+
+    def __init__(self):
+        self.pending_line = ''
+        self.block_lines = None
+        self.block_language = None
+
+    def feed(self, text: str) -> list[str]:
+        """Consumes the next chunk of the response and returns the Python blocks closed by it."""
+        closed_blocks = []
+        lines = (self.pending_line + text).split('\n')
+        self.pending_line = lines.pop()
+
+        for line in lines:
+            if self.block_lines is None:
+                if line.lstrip().startswith('```'):
+                    self.block_language = line.strip()[3:].strip().lower()
+                    self.block_lines = []
+            elif line.strip() == '```':
+                if self.block_language in PYTHON_LANGUAGES:
+                    closed_blocks.append('\n'.join(self.block_lines))
+                self.block_lines = None
+            else:
+                self.block_lines.append(line)
+
+        # The closing fence is usually the last thing in a chunk, before the newline arrives
+        if self.block_lines is not None and self.pending_line.strip() == '```':
+            if self.block_language in PYTHON_LANGUAGES:
+                closed_blocks.append('\n'.join(self.block_lines))
+            self.block_lines = None
+            self.pending_line = ''
+        return closed_blocks
\ No newline at end of file
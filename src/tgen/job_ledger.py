@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def digest(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class JobLedger:
+    """
+    Persistent state of batch jobs, one per (target, config, repetition), and of the test files each of them generated,
+    so that an interrupted run can be resumed without redoing finished jobs and test executions.
+    """
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    GENERATED = 'generated'
+    TESTED = 'tested'
+
+    def __init__(self, ledger_file: str):
+        self.ledger_file = ledger_file
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(ledger_file) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(ledger_file, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                          'job_id TEXT PRIMARY KEY, '
+                          'target TEXT NOT NULL, '
+                          'config TEXT NOT NULL, '
+                          'repetition INTEGER NOT NULL, '
+                          'state TEXT NOT NULL, '
+                          'updated REAL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS tests ('
+                          'job_id TEXT NOT NULL, '
+                          'seq INTEGER NOT NULL, '
+                          'output_dir TEXT NOT NULL, '
+                          'src_class TEXT NOT NULL, '
+                          'number INTEGER NOT NULL, '
+                          'test_path TEXT NOT NULL, '
+                          'result_path TEXT, '
+                          'digest TEXT, '
+                          'state TEXT NOT NULL, '
+                          'PRIMARY KEY (job_id, seq))')
+        self.conn.commit()
+
+    @staticmethod
+    def job_id(target: dict, config: dict, repetition: int) -> str:
+        return digest(json.dumps([target, config, repetition], sort_keys=True, default=str))[:32]
+
+    def add_job(self, job_id: str, target: dict, config: dict, repetition: int):
+        with self.lock:
+            self.conn.execute('INSERT OR IGNORE INTO jobs VALUES (?, ?, ?, ?, ?, ?)',
+                              (job_id, json.dumps(target, sort_keys=True, default=str),
+                               json.dumps(config, sort_keys=True, default=str), repetition, self.PENDING, time.time()))
+            self.conn.commit()
+
+    def job_state(self, job_id: str) -> str | None:
+        with self.lock:
+            row = self.conn.execute('SELECT state FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+            return row[0] if row else None
+
+    def set_job_state(self, job_id: str, state: str):
+        with self.lock:
+            self.conn.execute('UPDATE jobs SET state = ?, updated = ? WHERE job_id = ?', (state, time.time(), job_id))
+            self.conn.commit()
+
+    def reserve_test(self, job_id: str, seq: int, output_dir: str, src_class: str, first_free_number: int) -> int:
+        """
+        Returns the number of the `seq`-th test file of the job. A new number is reserved the first time, so resumed
+        jobs overwrite their own files and concurrent jobs writing to the same directory never share a number.
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT number FROM tests WHERE job_id = ? AND seq = ?', (job_id, seq)).fetchone()
+            if row:
+                return row[0]
+            row = self.conn.execute('SELECT MAX(number) FROM tests WHERE output_dir = ? AND src_class = ?',
+                                    (output_dir, src_class)).fetchone()
+            number = max(first_free_number, row[0] + 1 if row[0] is not None else 0)
+            self.conn.execute('INSERT INTO tests VALUES (?, ?, ?, ?, ?, ?, NULL, NULL, ?)',
+                              (job_id, seq, output_dir, src_class, number,
+                               os.path.join(output_dir, f'test_{src_class}_properties_{number}.py'), self.GENERATED))
+            self.conn.commit()
+            return number
+
+    def tested_result_path(self, job_id: str, seq: int, test_digest: str) -> str | None:
+        """Returns where the result of the `seq`-th test file is stored if that exact test already ran."""
+        with self.lock:
+            row = self.conn.execute('SELECT result_path FROM tests WHERE job_id = ? AND seq = ? AND digest = ? '
+                                    'AND state = ?', (job_id, seq, test_digest, self.TESTED)).fetchone()
+        return row[0] if row and os.path.isfile(row[0]) else None
+
+    def set_tested(self, job_id: str, seq: int, test_digest: str, result_path: str):
+        with self.lock:
+            self.conn.execute('UPDATE tests SET digest = ?, result_path = ?, state = ? WHERE job_id = ? AND seq = ?',
+                              (test_digest, result_path, self.TESTED, job_id, seq))
+            self.conn.commit()
+
+    def test_paths(self, job_id: str) -> list[tuple[str, str | None]]:
+        with self.lock:
+            return self.conn.execute('SELECT test_path, result_path FROM tests WHERE job_id = ? ORDER BY seq',
+                                     (job_id,)).fetchall()
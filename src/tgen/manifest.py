@@ -0,0 +1,39 @@
+import json
+from os import path
+
+TARGET_FIELDS = ('root_dir', 'src_file', 'src_class', 'test_file', 'test_methods', 'output_path', 'lib_src_file')
+REQUIRED_FIELDS = ('root_dir', 'src_class', 'output_path')
+
+
+def read_manifest_file(manifest_path: str):
+    with open(manifest_path, 'r') as f:
+        if manifest_path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("YAML manifests require the pyyaml package (pip install pyyaml), "
+                                  "or use a JSON manifest instead")
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def load_manifest(manifest_path: str) -> list[dict]:
+    """Loads the targets of a JSON/YAML manifest, which is either a list of targets or a dict with `targets` and
+    optional `defaults` shared by all of them. Relative root dirs are resolved against the manifest's directory."""
+    manifest = read_manifest_file(manifest_path)
+    defaults, targets = ({}, manifest) if isinstance(manifest, list) else (manifest.get('defaults', {}),
+                                                                         manifest['targets'])
+
+    loaded_targets = []
+    for i, target in enumerate(targets):
+        target = {**defaults, **target}
+        unknown = set(target) - set(TARGET_FIELDS)
+        missing = [f for f in REQUIRED_FIELDS if not target.get(f)]
+        if unknown or missing:
+            raise ValueError(f"Target {i} of {manifest_path} has unknown fields {sorted(unknown)} "
+                             f"or misses required fields {missing}")
+
+        target = {f: target.get(f) for f in TARGET_FIELDS}
+        target['root_dir'] = path.join(path.dirname(path.abspath(manifest_path)), target['root_dir'])
+        loaded_targets.append(target)
+    return loaded_targets
\ No newline at end of file
@@ -5,6 +5,7 @@ from src.config import PromptType
 from src.llm.invocation import Prompt
 from os import path
 from src.config import llm
+from src.tgen.test_runner import get_failures
 
 class PromptGenerator:
     def __init__(self, prompt_type: PromptType, temp: float, sample_size: int, model: str, for_app: bool):
@@ -15,6 +16,10 @@ class PromptGenerator:
         self.sample_size = sample_size
         self.model = model
         self.for_app = for_app
+        with open(path.join(llm['prompt-template-dir'], 'FEEDBACK.txt'), 'r') as f:
+            self.feedback_template = f.read()
+        with open(path.join(llm['prompt-template-dir'], 'RETRY_FEEDBACK.txt'), 'r') as f:
+            self.retry_feedback_template = f.read()
 
     def get_initial_prompt_txt(self, mod_name: str, cl_code: str, class_name: str, unittests_code: str) -> str:
         if (('mod_name' in self.prompt_template and not mod_name)
@@ -27,7 +32,7 @@ class PromptGenerator:
                                            unittests_code=unittests_code)
 
     def generate_initial_prompt(self, root_dir: str, src_file: str, class_name: str, test_file: str,
-                                test_methods: str) -> Prompt:
+                                test_methods: str, variant: int = 0) -> Prompt:
         if self.for_app:
             mod_name = src_file.replace('.py', '').replace('/', '.')
             src_path = path.join(root_dir, src_file)
@@ -53,4 +58,29 @@ class PromptGenerator:
 
         prompt_txt = self.get_initial_prompt_txt(mod_name, cl_code, class_name, unittests_code)
 
-        return Prompt([Prompt.Message("user", prompt_txt)], self.temp, self.sample_size, self.model)
\ No newline at end of file
+        return Prompt([Prompt.Message("user", prompt_txt)], self.temp, self.sample_size, self.model, variant)
+
+    @staticmethod
+    def format_failures(test_report: dict) -> str:
+        return '\n\n'.join(f'{name}:\n{error}'
+                           for name, error in get_failures(test_report, llm['feedback-max-error-lines']))
+
+    def generate_feedback_prompt(self, initial_prompt: Prompt, class_name: str, previous_response: str,
+                                 test_report: dict, rejected_response: str | None = None,
+                                 rejected_report: dict | None = None) -> Prompt:
+        # Only the latest answer and its failures are appended to the initial prompt, so every round sends the same
+        # prefix and a bounded delta instead of a conversation that grows with the number of rounds. If the latest
+        # answer didn't do better than the previous one, it is added as well, so the next round doesn't just repeat
+        # the same prompt
+        feedback_txt = self.feedback_template.format(class_name=class_name,
+                                                     failures=self.format_failures(test_report))
+        messages = [initial_prompt.messages[0],
+                    Prompt.Message("assistant", previous_response),
+                    Prompt.Message("user", feedback_txt)]
+        if rejected_response is not None:
+            retry_txt = self.retry_feedback_template.format(class_name=class_name,
+                                                           failures=self.format_failures(rejected_report))
+            messages += [Prompt.Message("assistant", rejected_response),
+                         Prompt.Message("user", retry_txt)]
+
+        return Prompt(messages, self.temp, 1, self.model, initial_prompt.variant)
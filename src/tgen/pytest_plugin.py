@@ -0,0 +1,130 @@
+import faulthandler
+import json
+import signal
+import sys
+import threading
+import traceback
+import pytest
+
+TIMEOUT_OUTCOME = 'timeout'
+
+
+class TestTimeout(BaseException):
+    # Not an Exception, so that Hypothesis and `except Exception` in tests don't catch it and keep running
+    pass
+
+
+def thread_dump() -> str:
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    return '\n'.join(f"Thread {names.get(ident, ident)}:\n{''.join(traceback.format_stack(frame))}"
+                     for ident, frame in sys._current_frames().items())
+
+
+class ChekPropWatchdog:
+    """
+    Loaded into the pytest subprocesses running generated tests. Stops tests running longer than `test_timeout`, dumps
+    the threads when a test times out or the parent sends SIGUSR1, and appends the outcome of every test stage to the
+    progress file as soon as it's known, so that the parent can still report a run it had to kill.
+    """
+
+    def __init__(self, progress_file: str | None, dump_file: str | None, test_timeout: float | None):
+        self.progress = open(progress_file, 'a') if progress_file else None
+        self.dump = open(dump_file, 'w') if dump_file else None
+        self.test_timeout = test_timeout
+        self.thread_dumps = {}
+        if self.dump:
+            faulthandler.register(signal.SIGUSR1, file=self.dump, all_threads=True)
+
+    def write_progress(self, **event):
+        if self.progress:
+            self.progress.write(json.dumps(event) + '\n')
+            self.progress.flush()
+
+    def on_timeout(self, nodeid: str):
+        # Disarmed explicitly, so that the alarm can't fire again while the test is unwinding or being reported
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        self.thread_dumps[nodeid] = thread_dump()
+        self.write_progress(event='timeout', nodeid=nodeid, thread_dump=self.thread_dumps[nodeid])
+        raise TestTimeout(f"Test took longer than {self.test_timeout}s")
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_protocol(self, item):
+        self.write_progress(event='start', nodeid=item.nodeid)
+        if not self.test_timeout:
+            yield
+            return
+
+        # The alarm interrupts Python code running in the main thread, e.g. an endless loop calling time.sleep. If the
+        # test is stuck where the alarm can't interrupt it, the process dumps its threads and exits a bit later
+        previous_handler = signal.signal(signal.SIGALRM, lambda signum, frame: self.on_timeout(item.nodeid))
+        signal.setitimer(signal.ITIMER_REAL, self.test_timeout)
+        if self.dump:
+            faulthandler.dump_traceback_later(self.test_timeout + 5, exit=True, file=self.dump)
+        try:
+            yield
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+            if self.dump:
+                faulthandler.cancel_dump_traceback_later()
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_makereport(self, item, call):
+        outcome = yield
+        report = outcome.get_result()
+        if call.excinfo is not None and call.excinfo.errisinstance(TestTimeout):
+            report.chekprop_timeout = True
+            # The exception is raised by the alarm handler, so the crash would point at this plugin instead of the
+            # line of the test that was running
+            crash = getattr(report.longrepr, 'reprcrash', None)
+            entry = next((e for e in reversed(call.excinfo.traceback) if e.path == item.path), None)
+            if crash and entry:
+                crash.path, crash.lineno = str(entry.path), entry.lineno + 1
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_report_teststatus(self, report):
+        if getattr(report, 'chekprop_timeout', False):
+            return TIMEOUT_OUTCOME, 'T', 'TIMEOUT'
+
+    def pytest_json_runtest_metadata(self, item, call):
+        metadata = {}
+        if call.when != 'call':
+            return metadata
+        if item.nodeid in self.thread_dumps:
+            metadata.update(timeout=self.test_timeout, thread_dump=self.thread_dumps[item.nodeid])
+        # Set by Hypothesis' pytest plugin for @given tests when --hypothesis-show-statistics is on
+        if getattr(item, 'hypothesis_statistics', None):
+            metadata['hypothesis_statistics'] = item.hypothesis_statistics
+        return metadata
+
+    def pytest_runtest_logreport(self, report):
+        crash = getattr(report.longrepr, 'reprcrash', None)
+        self.write_progress(event='report', nodeid=report.nodeid, when=report.when,
+                            outcome=TIMEOUT_OUTCOME if getattr(report, 'chekprop_timeout', False) else report.outcome,
+                            duration=report.duration, longrepr=report.longreprtext if report.failed else None,
+                            crash={'path': crash.path, 'lineno': crash.lineno, 'message': crash.message}
+                            if crash else None)
+
+    def close(self):
+        if self.dump:
+            faulthandler.unregister(signal.SIGUSR1)
+        for f in (self.progress, self.dump):
+            if f:
+                f.close()
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('chekprop')
+    group.addoption('--chekprop-progress-file', default=None,
+                    help="File to which the outcome of every test stage is appended as soon as it's known")
+    group.addoption('--chekprop-dump-file', default=None,
+                    help="File to which a thread dump is written on SIGUSR1 or when a test hangs")
+    group.addoption('--chekprop-test-timeout', type=float, default=None,
+                    help="Seconds after which a single test is stopped and reported as timed out")
+
+
+def pytest_configure(config):
+    watchdog = ChekPropWatchdog(config.getoption('chekprop_progress_file'), config.getoption('chekprop_dump_file'),
+                                config.getoption('chekprop_test_timeout'))
+    config.pluginmanager.register(watchdog, 'chekprop_watchdog')
+    config.add_cleanup(watchdog.close)
@@ -0,0 +1,48 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable
+from src.tgen.test_runner import TestRunnerPool
+
+RunTests = Callable[[str], dict]
+
+
+class BatchScheduler:
+    """
+    Runs many targets at once. Each target gets a thread for prompt generation and LLM calls, at most `llm_workers` of
+    them outside test runs at any time, while at most `test_workers` generated test files run, each in its own process.
+    """
+
+    def __init__(self, llm_workers: int, test_workers: int):
+        self.llm_workers = llm_workers
+        self.test_workers = test_workers
+        self.llm_slots = threading.Semaphore(llm_workers)
+        self.test_pool = None
+
+    def run_tests(self, test_path: str) -> dict:
+        # A target waiting for its tests gives its LLM slot to another target
+        self.llm_slots.release()
+        try:
+            return self.test_pool.run(test_path)
+        finally:
+            self.llm_slots.acquire()
+
+    def run_target(self, process_target: Callable[[dict, RunTests], None], target: dict):
+        with self.llm_slots:
+            process_target(target, self.run_tests)
+
+    def run(self, targets: list[dict], process_target: Callable[[dict, RunTests], None]) -> list[dict]:
+        """Calls `process_target(target, run_tests)` for all targets and returns the ones that failed."""
+        failed = set()
+        with (ThreadPoolExecutor(max_workers=self.llm_workers + self.test_workers) as threads,
+              TestRunnerPool(self.test_workers) as self.test_pool):
+            futures = {threads.submit(self.run_target, process_target, target): target for target in targets}
+            for future in as_completed(futures):
+                target = futures[future]
+                try:
+                    future.result()
+                except Exception:
+                    logging.exception(f"Generating PBT for {target['src_class']} in {target['root_dir']} failed")
+                    failed.add(id(target))
+        self.test_pool = None
+        return [target for target in targets if id(target) in failed]
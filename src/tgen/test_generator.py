@@ -1,11 +1,25 @@
+import logging
+from typing import Callable
 from src.config import *
-from src.llm.gemini import GeminiFlashLite2
-from src.llm.minmax import MinMaxM2
-from src.llm.invocation import Prompt
+from src.config import llm as llm_config
+from src.llm.invocation import Prompt, Response
+from src.llm.model_registry import get_adapter
 from .prompt_generator import PromptGenerator
+from .test_runner import is_passing, pass_count, pass_rate
 from src.llm.llm_adapter import LLMAdapter
 
 
+class Candidate:
+    def __init__(self, test: str, response: str, report: dict | None):
+        self.test = test
+        self.response = response
+        self.report = report
+
+    def score(self) -> tuple[float, float]:
+        # Higher pass rate first, then the faster test file
+        return pass_rate(self.report), -(self.report or {}).get('duration', float('inf'))
+
+
 class TestGenerator:
     def __init__(self, model: str, improvement_iterations: int, prompt_type: PromptType,
                  temp: float, sample_size: int, read_from_cache: bool, save_to_cache: bool, for_app: bool):
@@ -22,22 +36,114 @@ class TestGenerator:
     def extract_code_from_llm_response(response: str) -> str:
         return '\n'.join(response.split('```')[-2].strip().split('\n')[1:])
 
-    def generate_pbt_with_llm(self, root_dir: str, src_file: str, src_class: str,
-                              test_file: str, test_methods: str, llm: LLMAdapter) -> str:
-
-        prompt_generator = PromptGenerator(self.prompt_type, self.temp, self.sample_size, self.model, self.for_app)
-        initial_prompt = prompt_generator.generate_initial_prompt(root_dir, src_file, src_class, test_file, test_methods)
-
-        llm_response = llm.get_response(initial_prompt).samples[0].content
-        return self.extract_code_from_llm_response(llm_response)
-
-    def generate_pbt(self, root_dir: str, src_file: str, src_class: str, test_file: str, test_methods: str) -> str:
-        match self.model:
-            case 'google/gemini-2.0-flash-lite-preview-02-05:free':
-                gemini = GeminiFlashLite2(read_from_cache=self.read_from_cache, save_to_cache=self.save_to_cache)
-                return self.generate_pbt_with_llm(root_dir, src_file, src_class, test_file, test_methods, gemini)
-            case 'minimax/minimax-m2:free':
-                minmax = MinMaxM2(read_from_cache=self.read_from_cache, save_to_cache=self.save_to_cache)
-                return self.generate_pbt_with_llm(root_dir, src_file, src_class, test_file, test_methods, minmax)
-            case _:
-                raise ValueError(f"Model {self.model} is not supported")
\ No newline at end of file
+    @staticmethod
+    def is_complete_test_block(sample_index: int, code: str) -> bool:
+        # A streamed block that compiles and defines tests is the generated test file, the rest is trailing prose
+        if 'def test' not in code:
+            return False
+        try:
+            compile(code, f'<sample {sample_index}>', 'exec')
+        except SyntaxError:
+            return False
+        return True
+
+    def get_llm_response(self, llm: LLMAdapter, prompt: Prompt) -> Response:
+        # Concurrent batch jobs can send the same prompt, e.g. for manifest entries of the same class. Repetitions use
+        # separate cache variants, so they get responses of their own
+        if llm_config['stream-responses']:
+            return llm.get_shared_response(prompt, lambda p: llm.get_response_streaming(
+                p, on_code_block=self.is_complete_test_block))
+        return llm.get_shared_response(prompt, llm.get_response)
+
+    @staticmethod
+    def best_candidate(candidates: list[Candidate]) -> Candidate:
+        return max(candidates, key=Candidate.score)
+
+    def improve_pbt(self, llm: LLMAdapter, prompt_generator: PromptGenerator, initial_prompt: Prompt,
+                    src_class: str, response: str, test: str, run_tests: Callable[[str], dict]) -> Candidate:
+        """Repairs the test until it passes, runs out of iterations, or stops improving its pass count for
+        `improvement-patience` rounds, and returns the best candidate seen."""
+        best = Candidate(test, response, run_tests(test))
+        rejected = None
+        sent_prompts = set()
+        rounds_without_improvement = 0
+        for iteration in range(self.improvement_iterations):
+            if is_passing(best.report):
+                break
+
+            logging.info(f"Improvement iteration {iteration + 1}/{self.improvement_iterations} for {src_class}")
+            # Feedback is always about the best candidate, so a regression doesn't derail the next rounds, followed by
+            # the latest candidate that didn't beat it
+            feedback_prompt = prompt_generator.generate_feedback_prompt(
+                initial_prompt, src_class, best.response, best.report,
+                rejected.response if rejected else None, rejected.report if rejected else None)
+            if llm.read_from_cache and feedback_prompt.hash() in sent_prompts:
+                logging.info(f"Stopping improvement of {src_class}, the model repeated a rejected answer")
+                break
+            sent_prompts.add(feedback_prompt.hash())
+
+            response = self.get_llm_response(llm, feedback_prompt).samples[0].content
+            try:
+                test = self.extract_code_from_llm_response(response)
+            except (IndexError, AttributeError):
+                logging.warning(f"Improvement iteration {iteration + 1} for {src_class} returned no code block")
+                break
+
+            candidate = Candidate(test, response, run_tests(test))
+            if pass_count(candidate.report) > pass_count(best.report):
+                rounds_without_improvement = 0
+            else:
+                rounds_without_improvement += 1
+            best = self.best_candidate([best, candidate])
+            rejected = None if best is candidate else candidate
+
+            if rounds_without_improvement >= llm_config['improvement-patience']:
+                logging.info(f"Stopping improvement of {src_class}, no more tests passed "
+                             f"in the last {rounds_without_improvement} iterations")
+                break
+        return best
+
+    def get_prompt_generator(self) -> PromptGenerator:
+        return PromptGenerator(self.prompt_type, self.temp, self.sample_size, self.model, self.for_app)
+
+    def generate_initial_prompt(self, root_dir: str, src_file: str, src_class: str, test_file: str,
+                                test_methods: str, variant: int = 0) -> Prompt:
+        return self.get_prompt_generator().generate_initial_prompt(root_dir, src_file, src_class, test_file,
+                                                                   test_methods, variant)
+
+    def generate_pbt_with_llm(self, root_dir: str, src_file: str, src_class: str, test_file: str,
+                              test_methods: str, llm: LLMAdapter, run_tests: Callable[[str], dict] | None = None,
+                              variant: int = 0) -> list[Candidate]:
+
+        prompt_generator = self.get_prompt_generator()
+        initial_prompt = prompt_generator.generate_initial_prompt(root_dir, src_file, src_class, test_file,
+                                                                  test_methods, variant)
+
+        candidates = []
+        for i, sample in enumerate(self.get_llm_response(llm, initial_prompt).samples):
+            try:
+                test = self.extract_code_from_llm_response(sample.content)
+            except (IndexError, AttributeError):
+                logging.warning(f"Sample {i} of the LLM response does not contain a code block, skipping it")
+                continue
+
+            if run_tests:
+                candidates.append(self.improve_pbt(llm, prompt_generator, initial_prompt, src_class, sample.content,
+                                                   test, run_tests))
+            else:
+                candidates.append(Candidate(test, sample.content, None))
+
+        if not candidates:
+            raise ValueError("None of the LLM response samples contains a code block")
+        return candidates
+
+    def generate_pbt(self, root_dir: str, src_file: str, src_class: str, test_file: str,
+                     test_methods: str, run_tests: Callable[[str], dict] | None = None,
+                     variant: int = 0) -> list[Candidate]:
+        """Generates a test per sample. If `run_tests` is given, every candidate test is run with it, failing ones
+        are repaired with feedback prompts for up to `improvement_iterations` rounds, and the best candidate of each
+        sample is returned. Each `variant` reads and writes its own cached invocations, so repeated runs get
+        independent responses."""
+        llm = get_adapter(self.model, read_from_cache=self.read_from_cache, save_to_cache=self.save_to_cache)
+        return self.generate_pbt_with_llm(root_dir, src_file, src_class, test_file, test_methods, llm, run_tests,
+                                          variant)
\ No newline at end of file
@@ -1,8 +1,383 @@
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
 import pytest
-from pytest_jsonreport.plugin import JSONReport
+import src.config as conf
 
-def get_test_results(test_file: str) -> str:
-    with open(test_file, 'r') as f:
-        json_report = JSONReport()
-        pytest.main(['--json-report-file=none', test_file], plugins=[json_report])
-        return json_report.report
\ No newline at end of file
+
+# The subprocesses import the watchdog plugin from this repository, wherever they are started from
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+TIMEOUT_OUTCOME = 'timeout'
+
+
+def read_progress(progress_file: str) -> list[dict]:
+    with open(progress_file, 'r') as f:
+        return [json.loads(line) for line in f if line.endswith('\n')]
+
+
+def report_from_progress(test_file: str, progress: list[dict], thread_dump: str, exitcode: int, duration: float,
+                         timeout: dict) -> dict:
+    """Builds a JSON report of a killed pytest run from the outcomes its watchdog recorded. The test that was running
+    when the run was killed has the `timeout` outcome."""
+    tests = {}
+    for event in progress:
+        test = tests.setdefault(event['nodeid'], {'nodeid': event['nodeid'], 'outcome': 'passed'})
+        if event['event'] == 'report':
+            test[event['when']] = {key: event[key] for key in ('duration', 'outcome', 'crash', 'longrepr')
+                                   if event.get(key) is not None}
+            if event['outcome'] != 'passed' and test['outcome'] == 'passed':
+                test['outcome'] = 'error' if event['when'] != 'call' and event['outcome'] == 'failed' \
+                    else event['outcome']
+        elif event['event'] == 'timeout':
+            test['metadata'] = {'timeout': timeout['seconds'], 'thread_dump': event['thread_dump']}
+
+    for test in tests.values():
+        if 'teardown' not in test and test['outcome'] != TIMEOUT_OUTCOME:
+            test['outcome'] = TIMEOUT_OUTCOME
+            test['call'] = {'outcome': 'failed',
+                            'longrepr': f"Killed after {timeout['seconds']}s while running this test"}
+            test['metadata'] = {'timeout': timeout['seconds'], 'thread_dump': thread_dump}
+            timeout['nodeid'] = test['nodeid']
+
+    tests = list(tests.values())
+    return {'created': time.time() - duration, 'duration': duration, 'exitcode': exitcode, 'root': os.getcwd(),
+            'environment': {}, 'timeout': timeout,
+            'summary': dict(Counter(test['outcome'] for test in tests), total=len(tests), collected=len(tests)),
+            'collectors': [], 'tests': tests}
+
+
+def pytest_args(test_file: str, report_file: str, progress_file: str, dump_file: str,
+                test_timeout: float | None) -> list[str]:
+    args = ['-p', 'src.tgen.pytest_plugin', '--hypothesis-show-statistics', '--json-report',
+            f'--json-report-file={report_file}', f'--chekprop-progress-file={progress_file}',
+            f'--chekprop-dump-file={dump_file}']
+    if test_timeout:
+        args.append(f'--chekprop-test-timeout={test_timeout}')
+    return args + [test_file]
+
+
+def kill_session(pid: int, test_file: str, timeout: float):
+    # The watchdog dumps the threads on SIGUSR1 before the whole session is killed
+    try:
+        os.kill(pid, signal.SIGUSR1)
+        time.sleep(0.5)
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    logging.warning(f"Running {test_file} took longer than {timeout}s, killed it")
+
+
+def run_in_subprocess(args: list[str], stderr_file: str, test_file: str, timeout: float | None) -> tuple[int, bool]:
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in (REPO_ROOT, os.environ.get('PYTHONPATH')) if p))
+    with open(stderr_file, 'w') as stderr:
+        # The subprocess has its own session so that the threads and processes the tests started are killed with it
+        process = subprocess.Popen([sys.executable, '-m', 'pytest'] + args, cwd=os.getcwd(), env=env,
+                                   stdout=subprocess.DEVNULL, stderr=stderr, start_new_session=True)
+        try:
+            process.wait(timeout=timeout)
+            return process.returncode, False
+        except subprocess.TimeoutExpired:
+            kill_session(process.pid, test_file, timeout)
+            return process.wait(), True
+
+
+def run_pytest_in_worker(args: list[str], cwd: str, stderr_file: str):
+    # Runs in a process forked from the warm forkserver, with the slow imports already done
+    os.setsid()
+    os.chdir(cwd)
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    with open(os.devnull, 'w') as devnull, open(stderr_file, 'w') as stderr:
+        os.dup2(devnull.fileno(), 1)
+        os.dup2(stderr.fileno(), 2)
+    sys.exit(int(pytest.main(args)))
+
+
+_warm_context = None
+_warm_context_lock = threading.Lock()
+
+
+def get_warm_context():
+    """Returns the multiprocessing context whose forkserver has imported the modules generated tests need, so that
+    each test file runs in a cheap fork of it instead of a new interpreter."""
+    global _warm_context
+    with _warm_context_lock:
+        if _warm_context is None:
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(conf.test_runner['warm-worker-preload'])
+            _warm_context = context
+        return _warm_context
+
+
+def run_in_warm_worker(args: list[str], stderr_file: str, test_file: str, timeout: float | None) -> tuple[int, bool]:
+    # Not a daemon: daemonic processes can't start children, and generated tests may use multiprocessing
+    process = get_warm_context().Process(target=run_pytest_in_worker, args=(args, os.getcwd(), stderr_file))
+    process.start()
+    process.join(timeout)
+    if process.exitcode is None:
+        kill_session(process.pid, test_file, timeout)
+        process.join()
+        return process.exitcode, True
+    return process.exitcode, False
+
+
+_warm_workers_available = True
+
+
+def run_pytest(args: list[str], stderr_file: str, test_file: str, timeout: float | None,
+               backend: str) -> tuple[int, bool]:
+    """Runs pytest with `args` in a fork of the warm worker with the `forkserver` backend, or in a new interpreter
+    with the `subprocess` backend, and returns its exit code and whether it was killed after `timeout`."""
+    global _warm_workers_available
+    if backend == 'forkserver' and _warm_workers_available:
+        try:
+            return run_in_warm_worker(args, stderr_file, test_file, timeout)
+        except (ValueError, OSError) as e:
+            # e.g. platforms without the forkserver start method
+            logging.warning(f"Warm test workers are unavailable ({e}), running tests in new interpreters")
+            _warm_workers_available = False
+    return run_in_subprocess(args, stderr_file, test_file, timeout)
+
+
+def get_test_results(test_file: str, timeout: float | None = conf.test_runner['test-file-timeout'],
+                     test_timeout: float | None = conf.test_runner['test-timeout'],
+                     backend: str = conf.test_runner['runner-backend']) -> dict | None:
+    """
+    Runs the test file in its own pytest process, so pin factories, threads and modules left behind by a generated
+    test can't affect the next ones, and returns its JSON report (None if pytest didn't write one). The process is
+    forked from a warm worker with the `forkserver` backend, or a new interpreter with the `subprocess` backend.
+    Tests running longer than `test_timeout` are stopped and the whole file is killed after `timeout`. Both are
+    reported with the `timeout` outcome and a thread dump.
+    """
+    fd, report_file = tempfile.mkstemp(prefix='chekprop_report_', suffix='.json')
+    os.close(fd)
+    progress_file, dump_file, stderr_file = (report_file.replace('.json', suffix)
+                                             for suffix in ('.progress', '.dump', '.stderr'))
+    args = pytest_args(test_file, report_file, progress_file, dump_file, test_timeout)
+
+    start = time.monotonic()
+    try:
+        returncode, killed = run_pytest(args, stderr_file, test_file, timeout, backend)
+        timed_out = {'scope': 'file', 'seconds': timeout} if killed else None
+
+        with open(report_file, 'r') as f:
+            content = f.read()
+        if content and not timed_out:
+            return json.loads(content)
+
+        progress = read_progress(progress_file) if os.path.isfile(progress_file) else []
+        finished = {e['nodeid'] for e in progress if e['event'] == 'report' and e['when'] == 'teardown'}
+        if not timed_out and any(e['event'] == 'start' and e['nodeid'] not in finished for e in progress):
+            # A test the alarm couldn't interrupt made the watchdog exit the process
+            timed_out = {'scope': 'test', 'seconds': test_timeout}
+            logging.warning(f"A test of {test_file} took longer than {test_timeout}s and couldn't be stopped")
+        if not timed_out:
+            with open(stderr_file, 'r', errors='replace') as f:
+                logging.warning(f"pytest exited with {returncode} without a report for {test_file}: "
+                                f"{f.read().strip()}")
+            return None
+
+        with open(dump_file, 'r', errors='replace') as f:
+            thread_dump = f.read()
+        return report_from_progress(test_file, progress, thread_dump, returncode, time.monotonic() - start,
+                                    timed_out)
+    finally:
+        for path in (report_file, progress_file, dump_file, stderr_file):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def collect_test_ids(test_file: str, timeout: float | None = conf.test_runner['test-file-timeout'],
+                     backend: str = conf.test_runner['runner-backend']) -> list[str] | None:
+    """Returns the node IDs of the tests in the file, usable from the current working directory, or None if they
+    couldn't be collected. Collection runs like the tests themselves, so it sees the same modules and plugins."""
+    fd, report_file = tempfile.mkstemp(prefix='chekprop_collect_', suffix='.json')
+    os.close(fd)
+    stderr_file = report_file.replace('.json', '.stderr')
+    try:
+        returncode, killed = run_pytest(['--collect-only', '--json-report', f'--json-report-file={report_file}',
+                                         test_file], stderr_file, test_file, timeout, backend)
+        if killed:
+            return None
+        with open(report_file, 'r') as f:
+            content = f.read()
+        report = json.loads(content) if content else {}
+        if returncode != 0 or not content:
+            errors = [c['longrepr'] for c in report.get('collectors', []) if c.get('outcome') == 'failed']
+            if not errors:
+                with open(stderr_file, 'r', errors='replace') as f:
+                    errors = [f.read()]
+            # The whole error is in the report of the run that follows
+            logging.warning(f"Collecting the tests of {test_file} failed with exit code {returncode}: "
+                            f"{(errors[0].strip().splitlines() or [''])[-1]}")
+            return None
+    finally:
+        for path in (report_file, stderr_file):
+            if os.path.exists(path):
+                os.remove(path)
+
+    tests = sorted((item for collector in report.get('collectors', []) for item in collector.get('result', [])
+                    if item.get('type') == 'Function'), key=lambda item: item.get('lineno', 0))
+    # The reported IDs are relative to pytest's rootdir, which isn't necessarily the working directory
+    return [f"{test_file}::{item['nodeid'].split('::', 1)[1]}" for item in tests]
+
+
+def merge_test_results(reports: dict[str, dict | None], duration: float) -> dict:
+    """Merges the reports of separate runs of the tests of one file into a single report, as if the file was run at
+    once in `duration` seconds."""
+    merged = {'created': None, 'duration': duration, 'exitcode': 0, 'root': None, 'environment': {},
+              'summary': {}, 'collectors': [], 'tests': []}
+    collectors = {}
+    for test_id, report in reports.items():
+        if not report:
+            merged['exitcode'] = merged['exitcode'] or 1
+            merged['tests'].append({'nodeid': test_id, 'outcome': 'error',
+                                    'call': {'outcome': 'failed', 'longrepr': 'pytest did not produce a report'}})
+            continue
+
+        merged['created'] = min(merged['created'] or report['created'], report['created'])
+        merged['root'] = merged['root'] or report.get('root')
+        merged['environment'] = merged['environment'] or report.get('environment', {})
+        merged['exitcode'] = merged['exitcode'] or report.get('exitcode', 0)
+        for collector in report.get('collectors', []):
+            collectors.setdefault(collector['nodeid'], collector)
+        merged['tests'] += report.get('tests', [])
+        if 'warnings' in report:
+            merged.setdefault('warnings', []).extend(report['warnings'])
+
+    merged['collectors'] = list(collectors.values())
+    merged['summary'] = dict(Counter(test['outcome'] for test in merged['tests']),
+                             total=len(merged['tests']), collected=len(merged['tests']))
+    return merged
+
+
+class TestRunnerPool:
+    """
+    Runs up to `max_workers` test files at the same time, each in its own pytest process. With `split_tests`, the
+    tests of each file are run in separate processes as well and their reports are merged.
+    """
+
+    def __init__(self, max_workers: int = conf.test_runner['max-test-workers'],
+                 split_tests: bool = conf.test_runner['split-tests']):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='test-runner')
+        self.split_tests = split_tests
+
+    def submit(self, test_file: str) -> Future:
+        return self.executor.submit(get_test_results, test_file)
+
+    def run_split(self, test_file: str) -> dict | None:
+        start = time.monotonic()
+        test_ids = self.executor.submit(collect_test_ids, test_file).result()
+        if test_ids is None:
+            # A normal run of the file reports the collection errors
+            logging.warning(f"Couldn't collect the tests of {test_file}, running them in a single process")
+            return self.run_whole(test_file)
+        if len(test_ids) < 2:
+            # A single test has nothing to split
+            return self.run_whole(test_file)
+
+        futures = {test_id: self.submit(test_id) for test_id in test_ids}
+        reports = {test_id: future.result() for test_id, future in futures.items()}
+        return merge_test_results(reports, time.monotonic() - start)
+
+    def run_whole(self, test_file: str) -> dict | None:
+        return self.submit(test_file).result()
+
+    def run(self, test_file: str) -> dict | None:
+        return self.run_split(test_file) if self.split_tests else self.run_whole(test_file)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+def is_passing(report: dict | None) -> bool:
+    if not report:
+        return False
+    summary = report.get('summary', {})
+    return report.get('exitcode') == 0 and summary.get('total', 0) > 0 and summary.get('passed', 0) == summary['total']
+
+def pass_count(report: dict | None) -> int:
+    return report.get('summary', {}).get('passed', 0) if report else 0
+
+def pass_rate(report: dict | None) -> float:
+    total = report.get('summary', {}).get('total', 0) if report else 0
+    return pass_count(report) / total if total else 0
+
+def trim_lines(text: str, max_lines: int) -> str:
+    lines = text.strip().split('\n')
+    return '\n'.join(lines if len(lines) <= max_lines else ['...'] + lines[-max_lines:])
+
+FAILING_OUTCOMES = ('failed', 'error', TIMEOUT_OUTCOME)
+
+def test_error(test: dict) -> str:
+    stage = next((test[s] for s in ('setup', 'call', 'teardown') if test.get(s, {}).get('outcome') == 'failed'), {})
+    crash = stage.get('crash')
+    if not crash:
+        return stage.get('longrepr', test['outcome'])
+    if test['outcome'] == TIMEOUT_OUTCOME and os.path.basename(crash['path']) != \
+            os.path.basename(test['nodeid'].split('::')[0]):
+        # A line outside the test file would be mistaken for one of the test
+        return crash['message']
+    return f"line {crash['lineno']}: {crash['message']}"
+
+def compact_report(report: dict | None, max_lines: int = conf.test_runner['result-message-max-lines'],
+                   keep_full_report: bool = conf.test_runner['keep-full-report-on-failure']) -> dict | None:
+    """Reduces a pytest JSON report to the outcome, duration, trimmed error and Hypothesis statistics of each test.
+    If the file isn't passing and `keep_full_report` is set, the full report is returned instead."""
+    if not report or (keep_full_report and not is_passing(report)):
+        return report
+
+    compact = {'format': 'compact', 'created': report.get('created'), 'duration': report.get('duration'),
+               'exitcode': report.get('exitcode'), 'summary': report.get('summary', {})}
+    if 'timeout' in report:
+        compact['timeout'] = report['timeout']
+    compact['collection_errors'] = [{'nodeid': c['nodeid'], 'message': trim_lines(c.get('longrepr', ''), max_lines)}
+                                    for c in report.get('collectors', []) if c['outcome'] == 'failed']
+
+    compact['tests'] = []
+    for test in report.get('tests', []):
+        compact_test = {'nodeid': test['nodeid'], 'outcome': test['outcome'],
+                        'duration': sum(test.get(s, {}).get('duration', 0) for s in ('setup', 'call', 'teardown'))}
+        if test['outcome'] in FAILING_OUTCOMES:
+            compact_test['message'] = trim_lines(test_error(test), max_lines)
+        statistics = test.get('metadata', {}).get('hypothesis_statistics')
+        if statistics:
+            compact_test['hypothesis_statistics'] = statistics
+        compact['tests'].append(compact_test)
+
+    return compact
+
+def get_failures(report: dict | None, max_lines: int) -> list[tuple[str, str]]:
+    """Returns (test name, trimmed error) for every collection error and failing test of a full or compact report."""
+    if not report:
+        return [('session', 'pytest did not produce a report')]
+
+    failures = []
+    if report.get('format') == 'compact':
+        for error in report.get('collection_errors', []):
+            failures.append((error['nodeid'] or 'collection', trim_lines(error['message'], max_lines)))
+    for collector in report.get('collectors', []):
+        if collector['outcome'] == 'failed':
+            failures.append((collector['nodeid'] or 'collection', trim_lines(collector.get('longrepr', ''), max_lines)))
+
+    for test in report.get('tests', []):
+        if test['outcome'] not in FAILING_OUTCOMES:
+            continue
+        error = test.get('message', test['outcome']) if report.get('format') == 'compact' else test_error(test)
+        failures.append((test['nodeid'].split('::')[-1], trim_lines(error, max_lines)))
+    return failures
@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+os.environ.setdefault('OPENROUTER_API_KEY', 'test')
+
+import src.config as conf
+from src.llm import clients
+from src.llm.async_driver import get_responses
+from src.llm.invocation import Prompt
+from src.llm.openrouter import OpenRouterAdapter
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers chat completions after `server.delay` seconds, with a single choice if `server.ignore_n` is set."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server = self.server
+        with server.lock:
+            server.requests.append(request)
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(server.delay)
+            choices = 1 if server.ignore_n else request.get('n', 1)
+            body = json.dumps({'id': 'stub', 'object': 'chat.completion', 'created': 0, 'model': request['model'],
+                               'choices': [{'index': i, 'finish_reason': 'stop',
+                                            'message': {'role': 'assistant',
+                                                        'content': f"{request['messages'][-1]['content']}/{i}"}}
+                                           for i in range(choices)],
+                               'usage': {'prompt_tokens': 1, 'completion_tokens': 1, 'total_tokens': 2}}).encode()
+        finally:
+            with server.lock:
+                server.active -= 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def stub_server(monkeypatch, tmp_path):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.active = server.max_active = 0
+    server.delay = 0.2
+    server.ignore_n = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    url = f'http://127.0.0.1:{server.server_address[1]}/v1'
+    monkeypatch.setenv('OPENROUTER_API_URL', url)
+    monkeypatch.setitem(conf.llm, 'api-url', url)
+    monkeypatch.setitem(conf.llm, 'requests-per-minute', None)
+    monkeypatch.setitem(conf.llm, 'llm-invocation-cache-dir', str(tmp_path / 'cache'))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def prompt(content: str, sample_size: int = 1) -> Prompt:
+    return Prompt([Prompt.Message('user', content)], sample_size=sample_size)
+
+
+def test_requests_run_concurrently_up_to_the_limit(stub_server):
+    llm = OpenRouterAdapter(read_from_cache=False, save_to_cache=False, model='stub')
+    responses = get_responses(llm, [prompt(f'p{i}') for i in range(6)], max_concurrency=3)
+
+    assert [r.samples[0].content for r in responses] == [f'p{i}/0' for i in range(6)]
+    assert len(stub_server.requests) == 6
+    assert stub_server.max_active == 3
+
+
+def test_identical_prompts_share_one_request(stub_server):
+    llm = OpenRouterAdapter(read_from_cache=True, save_to_cache=True, model='stub')
+    responses = get_responses(llm, [prompt('same')] * 4 + [prompt('other')])
+
+    assert [r.samples[0].content for r in responses] == ['same/0'] * 4 + ['other/0']
+    assert len(stub_server.requests) == 2
+
+    # Now served from the cache
+    assert get_responses(llm, [prompt('same')])[0].samples[0].content == 'same/0'
+    assert len(stub_server.requests) == 2
+
+
+def test_identical_prompts_are_requested_separately_without_cache(stub_server):
+    llm = OpenRouterAdapter(read_from_cache=False, save_to_cache=False, model='stub')
+    get_responses(llm, [prompt('same')] * 3)
+
+    assert len(stub_server.requests) == 3
+
+
+def test_missing_samples_are_requested_when_n_is_ignored(stub_server):
+    stub_server.ignore_n = True
+    llm = OpenRouterAdapter(read_from_cache=False, save_to_cache=False, model='stub')
+    response = get_responses(llm, [prompt('p', sample_size=3)])[0]
+
+    assert len(response.samples) == 3
+    assert [r.get('n', 1) for r in stub_server.requests] == [3, 1, 1]
+
+
+def test_clients_of_the_run_are_closed(stub_server):
+    llm = OpenRouterAdapter(read_from_cache=False, save_to_cache=False, model='stub')
+    get_responses(llm, [prompt('p')])
+
+    assert not clients._async_clients